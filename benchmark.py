@@ -0,0 +1,183 @@
+import sys
+from hashlib import md5
+from math import cos, pi, sin
+from random import Random
+from resource import RUSAGE_SELF, getrusage
+from subprocess import check_output
+from time import perf_counter
+from flat import document, gray, shape
+from flat.rasterizer import _blend, _blendrow, numpy, rasterizer
+
+
+
+
+# Compares the rasterizer cell store, per-row array('i') accumulators, with
+# the (x, area) tuple lists it replaced. Each case runs in its own process
+# so that max RSS belongs to that case alone.
+#
+#     python benchmark.py
+
+
+
+
+class tuples(rasterizer):
+    
+    def __init__(self, width, height, kind, x=0, y=0):
+        rasterizer.__init__(self, width, height, kind, x, y)
+        self.scanlines = [[] for i in range(height)]
+    
+    def edge(self, x0, y0, x1, y1):
+        ox, oy = self.ox, self.oy
+        x0, y0, x1, y1 = x0 - ox, y0 - oy, x1 - ox, y1 - oy
+        if y0 < y1:
+            direction = 1
+        elif y0 > y1:
+            x0, y0, x1, y1 = x1, y1, x0, y0
+            direction = -1
+        else:
+            return
+        dx = x1 - x0
+        dy = y1 - y0
+        ax = abs(dx)
+        if y0 < 0:
+            bottom = 0
+            thgir = x0 + (-y0*dx + dy//2)//dy
+        else:
+            bottom = y0
+            thgir = x0
+        y1 = min(y1, self.image.height*256)
+        self.top = min(self.top, bottom)
+        self.bottom = max(self.bottom, y1)
+        while bottom < y1:
+            top = bottom
+            bottom = min((top & ~255) + 256, y1)
+            tfel = thgir
+            thgir = x0 + ((bottom - y0)*dx + dy//2)//dy
+            scanline = self.scanlines[top//256]
+            if tfel//256 == thgir//256:
+                r = (tfel & ~255) + 256
+                width = (r - tfel) + (r - thgir)
+                height = bottom - top
+                area = width*height//2
+                spill = 256*height - area
+                scanline.append((tfel//256, area*direction))
+                scanline.append((tfel//256 + 1, spill*direction))
+            else:
+                left, right = min(tfel, thgir), max(tfel, thgir)
+                b = top
+                r = left
+                previous = 0
+                while r < right:
+                    l = r
+                    r = (l & ~255) + 256
+                    if r <= right:
+                        width = r - l
+                        if r < right:
+                            t = b
+                            b = top + ((r - left)*dy + ax//2)//ax
+                            height = b - t
+                        else:
+                            height = bottom - b
+                        area = width*height//2
+                        spill = 256*height - area
+                    else:
+                        r = right
+                        width = r - l
+                        height = bottom - b
+                        spill = width*height//2
+                        area = 256*height - spill
+                    scanline.append((l//256, (area + previous)*direction))
+                    previous = spill
+                scanline.append(((right + 255)//256, previous*direction))
+    
+    def rasterize(self, c0=0, c1=0, c2=0, c3=0):
+        w, n = self.image.width, self.image.n
+        data, tables = self.image.data, self.tables
+        color = c0, c1, c2, c3
+        view = numpy.frombuffer(data, numpy.uint8) if numpy else None
+        top, bottom = self.top//256, (self.bottom + 255)//256
+        for y in range(top, bottom):
+            scanline = self.scanlines[y]
+            offset = y*w
+            if view is not None and len(scanline) >= 64:
+                cells = numpy.array(scanline)
+                xs = cells[:, 0]
+                left, right = max(0, xs.min()), min(xs.max(), w)
+                if left < right:
+                    areas = numpy.zeros(right - left + 1, numpy.int64)
+                    numpy.add.at(areas, xs.clip(left, right) - left, cells[:, 1])
+                    coverage = -numpy.cumsum(areas[:-1])
+                    _blendrow(view, (offset + left)*n, coverage, n, color)
+                scanline.clear()
+                continue
+            scanline.sort()
+            coverage = 0
+            for x, area in scanline:
+                if coverage == 0:
+                    x = max(0, x)
+                    i = (offset + x)*n
+                else:
+                    x = min(x, w)
+                    j = (offset + x)*n
+                    if i < j:
+                        alpha = (min(abs(coverage), 65536)*255 + 32768)//65536
+                        _blend(data, i, j, n, alpha, color, tables)
+                        i = j
+                coverage -= area
+            scanline.clear()
+        self.top, self.bottom = self.image.height, 0
+        return self.image
+
+
+
+
+designs = {'tuples': tuples, 'arrays': rasterizer}
+
+
+def polygon(vertices):
+    random = Random(1)
+    coordinates = []
+    for i in range(vertices):
+        a = 2.0*pi*i/vertices
+        r = 80.0 + 2.0*random.random()
+        coordinates += [105.0 + r*cos(a), 148.0 + r*sin(a)]
+    return coordinates
+
+
+def run(design, ppi):
+    d = document(210, 297, 'mm')
+    p = d.addpage()
+    p.place(shape().fill(gray(0)).nostroke().polygon(polygon(100000)))
+    k = ppi/72.0
+    w, h = int(p.width*k + 0.5), int(p.height*k + 0.5)
+    start = perf_counter()
+    r = designs[design](w, h, 'g')
+    for item in p.items:
+        item.rasterize(r, k, 0.0, 0.0)
+    elapsed = perf_counter() - start
+    rss = getrusage(RUSAGE_SELF).ru_maxrss/1024.0
+    return '%.2f %.0f %s' % (elapsed, rss, md5(r.image.data).hexdigest())
+
+
+def main():
+    print('%-8s %5s %9s %9s' % ('', 'ppi', 'time', 'max rss'))
+    for ppi in (72, 300):
+        digests = set()
+        for design in designs:
+            output = check_output([sys.executable, __file__, design, str(ppi)])
+            elapsed, rss, digest = output.decode().split()
+            digests.add(digest)
+            print('%-8s %5d %7s s %6s MB' % (design, ppi, elapsed, rss))
+        if len(digests) != 1:
+            raise ValueError('Different output.')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3:
+        print(run(sys.argv[1], int(sys.argv[2])))
+    else:
+        main()
+
+
+
+
@@ -128,6 +128,9 @@ class curveto(object):
 
 class closepath(object):
     
+    def __reduce__(self):
+        return 'closepath'
+    
     def transform(self, a, b, c, d, e, f):
         return self
     
@@ -148,3 +151,23 @@ closepath = closepath()
 
 
 
+def bounds(commands):
+    xs, ys = [], []
+    for c in commands:
+        if c == closepath:
+            continue
+        if isinstance(c, curveto):
+            xs += c.x1, c.x2
+            ys += c.y1, c.y2
+        elif isinstance(c, quadto):
+            xs.append(c.x1)
+            ys.append(c.y1)
+        xs.append(c.x)
+        ys.append(c.y)
+    if not xs:
+        return None
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+
+
@@ -1,5 +1,9 @@
+from math import ceil, floor
+from multiprocessing import Pool
+from .image import image
 from .misc import save, scale
 from .pdf import serialize as pdfserialize
+from .png import stream as pngstream
 from .rasterizer import rasterizer
 from .svg import serialize as svgserialize
 
@@ -39,13 +43,105 @@ class page(object):
         data = svgserialize(self, compress)
         return save(path, data)
     
-    def image(self, ppi=72, kind='g'):
+    def image(self, ppi=72, kind='g', workers=1):
         k = ppi/72.0
         w, h = int(self.width*k + 0.5), int(self.height*k + 0.5)
-        r = rasterizer(w, h, kind)
-        for item in self.items:
+        if workers <= 1:
+            r = rasterizer(w, h, kind)
+            for item in self.items:
+                if r.visible(item.bounds(k, 0.0, 0.0)):
+                    item.rasterize(r, k, 0.0, 0.0)
+            return r.image
+        i = image(w, h, kind)
+        bounds = [item.bounds(k, 0.0, 0.0) for item in self.items]
+        size = max(1, -(-h//(4*workers)))
+        tops = range(0, h, size)
+        context = (self.items, bounds, k, w, h, kind, size),
+        with Pool(workers, _band_initializer, context) as pool:
+            for top, band in zip(tops, pool.imap(_band, tops)):
+                i.data[top*w*i.n:top*w*i.n+len(band.data)] = band.data
+        return i
+    
+    def renderer(self, ppi=72, kind='g'):
+        return renderer(self, ppi, kind)
+    
+    def png(self, path, ppi=72, kind='g', optimized=False, band_height=256):
+        k = ppi/72.0
+        w, h = int(self.width*k + 0.5), int(self.height*k + 0.5)
+        bounds = [item.bounds(k, 0.0, 0.0) for item in self.items]
+        context = self.items, bounds, k, w, h, kind, max(1, band_height)
+        bands = (_band(top, context) for top in range(0, h, context[-1]))
+        with open(path, 'wb') as f:
+            pngstream(f, w, h, kind, bands, optimized)
+
+
+
+
+class renderer(object):
+    
+    __slots__ = 'page', 'k', 'kind', 'image', 'bounds'
+    
+    def __init__(self, page, ppi, kind):
+        self.page, self.k, self.kind = page, ppi/72.0, kind
+        self.image = page.image(ppi, kind)
+        self.bounds = {id(item): (item, item.bounds(self.k, 0.0, 0.0))
+            for item in page.items}
+    
+    def update(self, items):
+        k, w, h = self.k, self.image.width, self.image.height
+        placed = set(map(id, self.page.items))
+        region = None
+        for item in items:
+            changes = []
+            if id(item) in self.bounds:
+                changes.append(self.bounds.pop(id(item))[1])
+            if id(item) in placed:
+                b = item.bounds(k, 0.0, 0.0)
+                self.bounds[id(item)] = item, b
+                changes.append(b)
+            for b in changes:
+                if b is None:
+                    b = 0, 0, w, h
+                if region is None:
+                    region = b
+                else:
+                    region = (
+                        min(region[0], b[0]), min(region[1], b[1]),
+                        max(region[2], b[2]), max(region[3], b[3]))
+        if region is None:
+            return self.image
+        x0, y0 = max(0, int(floor(region[0]))), max(0, int(floor(region[1])))
+        x1, y1 = min(w, int(ceil(region[2]))), min(h, int(ceil(region[3])))
+        if x0 >= x1 or y0 >= y1:
+            return self.image
+        r = rasterizer(x1 - x0, y1 - y0, self.kind, x0, y0)
+        for item in self.page.items:
+            if id(item) not in self.bounds:
+                self.bounds[id(item)] = item, item.bounds(k, 0.0, 0.0)
+            if r.visible(self.bounds[id(item)][1]):
+                item.rasterize(r, k, 0.0, 0.0)
+        self.image.blit(x0, y0, r.image)
+        return self.image
+
+
+
+
+_global_context = None
+
+
+def _band_initializer(context):
+    global _global_context
+    _global_context = context
+
+
+def _band(top, context=None):
+    items, bounds, k, w, h, kind, size = context or _global_context
+    bottom = min(top + size, h)
+    r = rasterizer(w, bottom - top, kind, 0, top)
+    for item, b in zip(items, bounds):
+        if r.visible(b):
             item.rasterize(r, k, 0.0, 0.0)
-        return r.image
+    return r.image
 
 
 
@@ -1,3 +1,4 @@
+from .misc import load
 from .otf import otf
 
 
@@ -6,18 +7,18 @@ from .otf import otf
 class font(object):
     
     @staticmethod
-    def open(path, index=0):
-        with open(path, 'rb') as f:
-            data = f.read()
-            if otf.valid(data):
-                source = otf(data, index)
-                return font(source)
-            raise ValueError('Unsupported font format.')
+    def open(path, index=0, mmap=False):
+        data = load(path, mmap)
+        if otf.valid(data):
+            source = otf(data, index)
+            return font(source)
+        raise ValueError('Unsupported font format.')
     
     def __init__(self, source):
         self.source = source
         self.name = source.psname()
         self.density = source.density()
+        self.bounds = source.bounds()
         self.ascender = source.ascender()
         self.descender = source.descender()
         self.charmap = source.charmap()
@@ -1,5 +1,72 @@
+from collections import OrderedDict
 from copy import copy
+from math import ceil, floor
 from .misc import dump, scale
+from .rasterizer import layer, rasterizer
+
+
+
+
+_subpixels = 4
+_capacity = 32*1024*1024
+_layers = OrderedDict()
+_size = 0
+
+
+def _union(items, k, x, y):
+    result = None
+    for item in items:
+        b = item.bounds(k, x, y)
+        if b is None:
+            return None
+        if result is None:
+            result = b
+        else:
+            result = (
+                min(result[0], b[0]), min(result[1], b[1]),
+                max(result[2], b[2]), max(result[3], b[3]))
+    return result
+
+def _layer(group, kind, k, u, v):
+    # Placements at the same scale and subpixel offset share the items
+    # drawn once over white and once over black, unless too large. With
+    # alpha, blending does not depend linearly on what is below, so
+    # those are always drawn item by item.
+    global _size
+    if kind == 'ga' or kind == 'rgba':
+        return None
+    key = group, kind, k, u, v
+    if key in _layers:
+        _layers.move_to_end(key)
+        return _layers[key]
+    x, y = u/_subpixels, v/_subpixels
+    b = _union(group.items, k, x, y)
+    if b is None:
+        return None
+    left, top = int(floor(b[0])), int(floor(b[1]))
+    width, height = int(ceil(b[2])) - left, int(ceil(b[3])) - top
+    n = 1 if kind == 'g' else 3
+    if (2*n + 4)*width*height > _capacity//8: # all pixels partially covered
+        return None
+    images = []
+    for background in (255, 0):
+        r = rasterizer(width, height, kind, left, top)
+        if background == 0:
+            r.image.data[:] = bytes(width*height*r.image.n)
+        for item in group.items:
+            item.rasterize(r, k, x, y)
+        images.append(r.image)
+    l = _layers[key] = layer(left, top, images[0], images[1])
+    _size += l.size
+    while _size > _capacity:
+        _, evicted = _layers.popitem(False)
+        _size -= evicted.size
+    return l
+
+def _invalidate(group):
+    global _size
+    for key in [key for key in _layers if key[0] is group]:
+        _size -= _layers.pop(key).size
 
 
 
@@ -31,6 +98,10 @@ class group(object):
     
     def placed(self, k):
         return placedgroup(self, k)
+    
+    def invalidate(self):
+        _invalidate(self)
+        return self
 
 
 
@@ -69,9 +140,19 @@ class placedgroup(object):
             dump(self.x), dump(self.y),
             code)
     
+    def bounds(self, k, x, y):
+        return _union(self.item.items, self.factor*k, self.x*k+x, self.y*k+y)
+    
     def rasterize(self, rasterizer, k, x, y):
+        k, x, y = self.factor*k, self.x*k+x, self.y*k+y
+        u, v = int(floor(x*_subpixels + 0.5)), int(floor(y*_subpixels + 0.5))
+        l = _layer(self.item, rasterizer.image.kind, k, u % _subpixels, v % _subpixels)
+        if l is not None:
+            rasterizer.composite(u//_subpixels, v//_subpixels, l)
+            return
         for item in self.item.items:
-            item.rasterize(rasterizer, self.factor*k, self.x*k+x, self.y*k+y)
+            if rasterizer.visible(item.bounds(k, x, y)):
+                item.rasterize(rasterizer, k, x, y)
 
 
 
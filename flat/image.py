@@ -1,8 +1,19 @@
+from array import array
 from base64 import b64encode
-from math import ceil, exp, floor, log, pi, sin
-from .jpeg import jpeg, serialize as jpegserialize
-from .misc import dump, save, similar
-from .png import png, serialize as pngserialize
+from collections import OrderedDict
+from itertools import accumulate, count, islice, repeat
+from math import ceil, exp, floor, log, pi, sin, sqrt
+from operator import add, floordiv, itemgetter, mul, rshift, sub, truediv
+from weakref import ref
+from zlib import crc32
+from .jpeg import jpeg, probe as jpegprobe, serialize as jpegserialize, stream as jpegstream
+from .misc import dump, load, save, similar
+from .png import png, probe as pngprobe, serialize as pngserialize, stream as pngstream
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 
@@ -50,32 +61,286 @@ def _kernel_contribution(index, scale, length, kernel, support):
             weights[i] /= total
     return left, weights
 
+def _interpolation(interpolation):
+    if interpolation == 'nearest':
+        return nearest_kernel, 0.5
+    if interpolation == 'bicubic':
+        return _bicubic_kernel, 2.0
+    if interpolation == 'lanczos':
+        return _lanczos_kernel, 5.0
+    raise ValueError('Invalid interpolation.')
+
+def _dimensions(w, h, width, height):
+    if width == 0 and height == 0:
+        return w, h
+    if width == 0:
+        width = max(1, (height*w)//h)
+    elif height == 0:
+        height = max(1, (width*h)//w)
+    return width, height
+
+def _contributions(length, size, kernel, support):
+    scale = length/size
+    return [_kernel_contribution(i, scale, length, kernel, support)
+        for i in range(size)]
+
+def _taps(length, size, n, kernel, support):
+    # The k-th contributions of all destination pixels, padded with zero
+    # weights, so that a resampled row is a weighted sum of whole rows.
+    contributions = _contributions(length, size, kernel, support)
+    result = []
+    for k in range(max(len(weights) for _, weights in contributions)):
+        indices, factors = [], []
+        for left, weights in contributions:
+            i = (left + min(k, len(weights) - 1))*n
+            w = weights[k] if k < len(weights) else 0.0
+            for component in range(n):
+                indices.append(i + component)
+                factors.append(w)
+        result.append((indices, factors))
+    return result
+
+def _accumulate(rows, weights):
+    result = None
+    for row, weight in zip(rows, weights):
+        products = map(mul, row, weight)
+        if result is None:
+            result = list(products)
+        else:
+            result = list(map(add, result, products))
+    return result
+
+def _horizontal(length, size, n, kernel, support):
+    # Returns a function resampling a row. Values taking many source
+    # values are each summed on their own. Otherwise all values take
+    # their k-th tap at once, ordered by the number of taps so that the
+    # k-th tap applies to a prefix of them.
+    contributions = _contributions(length, size, kernel, support)
+    if max(len(weights) for _, weights in contributions) >= 12:
+        slices = [slice(left*n + component, (left + len(weights))*n, n)
+            for left, weights in contributions for component in range(n)]
+        factors = [weights for _, weights in contributions for _ in range(n)]
+        return lambda row: list(map(sum, map(map,
+            repeat(mul), map(row.__getitem__, slices), factors)))
+    order = sorted(range(size), key=lambda i: -len(contributions[i][1]))
+    taps = []
+    for k in range(len(contributions[order[0]][1])):
+        indices, factors = [], []
+        for i in order:
+            left, weights = contributions[i]
+            if k >= len(weights):
+                break
+            for component in range(n):
+                indices.append((left + k)*n + component)
+                factors.append(weights[k])
+        taps.append((itemgetter(*indices) if len(indices) > 1 else
+            itemgetter(slice(indices[0], indices[0] + 1)), factors))
+    positions = [0]*size
+    for j, i in enumerate(order):
+        positions[i] = j
+    restore = itemgetter(*[j*n + component for j in positions for component in range(n)])
+    def resampled(row):
+        pick, factors = taps[0]
+        result = list(map(mul, pick(row), factors))
+        for pick, factors in taps[1:]:
+            m = len(factors)
+            result[:m] = map(add, result[:m], map(mul, pick(row), factors))
+        return list(restore(result)) if size*n > 1 else result
+    return resampled
+
+def _resampling(rows, w, h, n, width, height, kernel, support):
+    # Source rows are read as needed and resampled horizontally, then
+    # kept only while the destination rows still need them.
+    ycontributions = _contributions(h, height, kernel, support)
+    if numpy:
+        xtaps = [(numpy.array(indices), numpy.array(factors))
+            for indices, factors in _taps(w, width, n, kernel, support)]
+    else:
+        horizontal = _horizontal(w, width, n, kernel, support)
+    rows, resampled, read = iter(rows), {}, 0
+    for y in range(height):
+        left, weights = ycontributions[y]
+        right = left + len(weights)
+        for i in [i for i in resampled if i < left]:
+            del resampled[i]
+        while read < right:
+            row = next(rows)
+            if read >= left:
+                if numpy:
+                    row, values = numpy.frombuffer(row, numpy.uint8), 0.0
+                    for i, factors in xtaps:
+                        values = values + row[i]*factors
+                    resampled[read] = values
+                else:
+                    resampled[read] = horizontal(row)
+            read += 1
+        if numpy:
+            values = 0.0
+            for i, weight in zip(range(left, right), weights):
+                values = values + resampled[i]*weight
+            yield numpy.clip(values + 0.5, 0, 255).astype(numpy.uint8).tobytes()
+        else:
+            yield _quantize(_accumulate(
+                (resampled[i] for i in range(left, right)), map(repeat, weights)))
+
+def _reduction(rows, w, h, n, factor):
+    # Blocks on the right and bottom edges average the pixels left.
+    width, height = -(-w//factor), -(-h//factor)
+    cw = w - (width - 1)*factor
+    padding = [0]*(width*factor - w)
+    rows = iter(rows)
+    for y in range(height):
+        count = min(factor, h - y*factor)
+        sums = list(next(rows))
+        for k in range(1, count):
+            sums = list(map(add, sums, next(rows)))
+        counts = [count*factor]*(width - 1) + [count*cw]
+        halves = [c//2 for c in counts]
+        result = bytearray(width*n)
+        for component in range(n):
+            values = sums[component::n] + padding
+            blocks = values[0::factor]
+            for k in range(1, factor):
+                blocks = map(add, blocks, values[k::factor])
+            result[component::n] = bytes(
+                map(floordiv, map(add, blocks, halves), counts))
+        yield result
+
+def _rows(bands, wn):
+    for band in bands:
+        for i in range(0, len(band), wn):
+            yield band[i:i + wn]
+
+def _box_radii(variance, count=3):
+    # Box sizes approximating Gaussian of the variance when repeated,
+    # after Kovesi, P. (2010).
+    ideal = sqrt(12.0*variance/count + 1.0)
+    lower = int(ideal)
+    if lower%2 == 0:
+        lower -= 1
+    m = (12.0*variance - count*lower*lower - 4*count*lower - 3*count)/(-4*lower - 4)
+    m = max(0, min(int(m + 0.5), count))
+    return [(lower - 1)//2]*m + [(lower + 1)//2]*(count - m)
+
+def _box(length, radius):
+    # Running sum over at most 2*radius + 1 values, fewer at the ends.
+    lows = [max(0, i - radius) for i in range(length)]
+    highs = [min(length, i + radius + 1) for i in range(length)]
+    counts = list(map(sub, highs, lows))
+    return itemgetter(*lows), itemgetter(*highs), counts, [count//2 for count in counts]
+
+def _box_line(line, low, high, counts, halves):
+    sums = [0]
+    sums += accumulate(line)
+    return bytes(map(floordiv,
+        map(add, map(sub, high(sums), low(sums)), halves), counts))
+
+def _bayer(size):
+    # Threshold matrix after Bayer, B. E. (1973). An optimum method for
+    # two-level rendition of continuous-tone pictures.
+    matrix = [[0]]
+    while len(matrix) < size:
+        n = len(matrix)
+        matrix = [[4*matrix[y % n][x % n] + ((0, 2), (3, 1))[y//n][x//n]
+            for x in range(2*n)] for y in range(2*n)]
+    return matrix
+
+_orderings = {}
+
+def _ordering(levels):
+    # A table per threshold, so that a row is dithered by eight
+    # strided translations.
+    if levels not in _orderings:
+        l = levels - 1
+        _orderings[levels] = [
+            [bytes(255*((128*v*l + (2*t + 1)*255)//32640)//l for v in range(256)) for t in row]
+            for row in _bayer(8)]
+    return _orderings[levels]
+
+def _ordered(row, y, tables):
+    tables, row = tables[y % 8], bytearray(row)
+    for k in range(8):
+        row[k::8] = row[k::8].translate(tables[k])
+    return row
+
+def _gamma_table(value):
+    return bytes(int((i/255.0)**value*255.0 + 0.5) for i in range(256))
+
+_inversion = bytes(range(255, -1, -1))
+
+# The coefficients of the JPEG encoder, in 16.16 fixed point.
+_red = [19595*v for v in range(256)]
+_green = [38470*v for v in range(256)]
+_blue = [7471*v + 32768 for v in range(256)]
+
+# Products a*c at a*256 + c, and their sums rounded back down by 255.
+_products = [a*c for a in range(256) for c in range(256)]
+_quotients = bytes((v + 127)//255 for v in range(255*255 + 1))
+
+def _over(background):
+    # Component c of alpha a over background, at a*256 + c.
+    return bytes((c*a + background*(255 - a) + 127)//255
+        for a in range(256) for c in range(256))
+
+def _quantize(values):
+    return bytes(map(min, repeat(255), map(max, repeat(0),
+        map(int, map(add, values, repeat(0.5))))))
+
 
 
 
 class image(object):
     
-    __slots__ = 'width', 'height', 'kind', 'n', 'data', 'source'
+    __slots__ = 'width', 'height', 'kind', 'n', 'data', 'source', '__weakref__'
+    
+    @staticmethod
+    def open(path, mmap=False):
+        data = load(path, mmap)
+        if jpeg.valid(data):
+            source = jpeg(data)
+            rotation = source.rotation
+        elif png.valid(data):
+            source = png(data)
+            rotation = 0
+        else:
+            raise ValueError('Unsupported image format.')
+        i = image(0, 0, source.kind)
+        if rotation == 90 or rotation == 270:
+            i.width, i.height = source.height, source.width
+        else:
+            i.width, i.height = source.width, source.height
+        i.source = source
+        return i
+    
+    @staticmethod
+    def budget(size):
+        global _budget
+        _budget = size
+        _evict()
     
     @staticmethod
-    def open(path):
+    def probe(path):
         with open(path, 'rb') as f:
-            data = f.read()
-            if jpeg.valid(data):
-                source = jpeg(data)
-                rotation = source.rotation
-            elif png.valid(data):
-                source = png(data)
-                rotation = 0
+            header = f.read(8)
+            f.seek(0)
+            if jpeg.valid(header):
+                width, height, kind, rotation = jpegprobe(f)
+            elif png.valid(header):
+                width, height, kind, rotation = pngprobe(f)
             else:
                 raise ValueError('Unsupported image format.')
-            i = image(0, 0, source.kind)
-            if rotation == 90 or rotation == 270:
-                i.width, i.height = source.height, source.width
-            else:
-                i.width, i.height = source.width, source.height
-            i.source = source
-            return i
+        if rotation == 90 or rotation == 270:
+            width, height = height, width
+        return width, height, kind, rotation
+    
+    @staticmethod
+    def frombuffer(width, height, kind, buffer):
+        i = image(0, 0, kind)
+        data = memoryview(buffer).cast('B')
+        if len(data) != width*height*i.n:
+            raise ValueError('Invalid buffer size.')
+        i.width, i.height, i.data = width, height, data
+        return i
     
     def __init__(self, width, height, kind='rgb'):
         self.width, self.height = width, height
@@ -94,30 +359,60 @@ class image(object):
         self.source = None
     
     def __eq__(self, other):
-        self.decompress(); other.decompress()
+        a, b = self._read().data, other._read().data
         return self.width == other.width and self.height == other.height and \
-            self.kind == other.kind and self.data == other.data
+            self.kind == other.kind and a == b
     
     def __ne__(self, other):
         return not self == other
     
+    def __buffer__(self, flags):
+        self.decompress()
+        return memoryview(self.data)
+    
+    @property
+    def __array_interface__(self):
+        self.decompress()
+        h, w, n = self.height, self.width, self.n
+        return {
+            'version': 3,
+            'shape': (h, w) if n == 1 else (h, w, n),
+            'typestr': '|u1',
+            'data': self.data}
+    
     def copy(self):
         i = image(0, 0, self.kind)
-        i.width, i.height = self.width, self.height
-        i.data[:], i.source = self.data, self.source
+        i.width, i.height, i.source = self.width, self.height, self.source
+        if not self.source or id(self) in _decoded:
+            i.data[:] = self.data
+            if self.source:
+                _remember(i)
         return i
     
+    def _read(self):
+        # Pixels decoded only to be read stay with the source, counted
+        # against the budget meanwhile, and may be dropped to be decoded
+        # again later.
+        source = self.source
+        if source and id(self) in _decoded:
+            _decoded.move_to_end(id(self))
+        elif source:
+            i = image(source.width, source.height, source.kind)
+            i.data = source.decompress()
+            rotation = source.rotation if isinstance(source, jpeg) else 0
+            if rotation == 90 or rotation == 270:
+                i.rotate(rotation == 90)
+            elif rotation == 180:
+                i.flip(True, True)
+            self.data = i.data
+            _remember(self)
+        return self
+    
     def decompress(self):
+        self._read()
         if self.source:
-            source, self.source = self.source, None
-            self.data[:] = source.decompress()
-            if isinstance(source, jpeg):
-                rotation = source.rotation
-                if rotation == 90 or rotation == 270:
-                    self.width, self.height = self.height, self.width
-                    self.rotate(rotation == 90)
-                elif rotation == 180:
-                    self.flip(True, True)
+            _forget(id(self))
+            self.source = None
         return self
     
     def get(self, x, y):
@@ -150,41 +445,25 @@ class image(object):
     
     def white(self):
         self.decompress()
-        kind, data = self.kind, self.data
-        for i in range(0, self.width*self.height*self.n, self.n):
-            if kind == 'g':
-                data[i] = 255
-            elif kind == 'ga':
-                data[i] = 255
-                data[i+1] = 0
-            elif kind == 'rgb':
-                data[i] = data[i+1] = data[i+2] = 255
-            elif kind == 'rgba':
-                data[i] = data[i+1] = data[i+2] = 255
-                data[i+3] = 0
-            else: # cmyk
-                data[i] = data[i+1] = data[i+2] = data[i+3] = 0
+        kind, n = self.kind, self.n
+        if kind == 'ga' or kind == 'rgba':
+            pixel = b'\xff'*(n - 1) + b'\0'
+        elif kind == 'cmyk':
+            pixel = b'\0'*4
+        else:
+            pixel = b'\xff'*n
+        self.data[:] = pixel*(self.width*self.height)
         return self
     
     def black(self):
         self.decompress()
-        kind, data = self.kind, self.data
-        for i in range(0, self.width*self.height*self.n, self.n):
-            if kind == 'g':
-                data[i] = 0
-            elif kind == 'ga':
-                data[i] = data[i+1] = 0
-            elif kind == 'rgb':
-                data[i] = data[i+1] = data[i+2] = 0
-            elif kind == 'rgba':
-                data[i] = data[i+1] = data[i+2] = data[i+3] = 0
-            else: # cmyk
-                data[i] = data[i+1] = data[i+2] = 0
-                data[i+3] = 255
+        pixel = b'\0\0\0\xff' if self.kind == 'cmyk' else b'\0'*self.n
+        self.data[:] = pixel*(self.width*self.height)
         return self
     
     def blit(self, x, y, source):
         self.decompress()
+        source._read()
         if self.kind != source.kind:
             raise ValueError('Different image kind.')
         w, h, n = self.width, self.height, self.n
@@ -199,95 +478,133 @@ class image(object):
             self.data[i:i + width*n] = source.data[j:j + width*n]
         return self
     
+    def composite(self, x, y, source, opacity=1.0):
+        self.decompress()
+        source._read()
+        if self.kind.rstrip('a') != source.kind.rstrip('a'):
+            raise ValueError('Different image kind.')
+        if source is self:
+            source = source.copy()
+        w, h, n, m = self.width, self.height, self.n, source.n
+        sw, sh = source.width, source.height
+        colors = n - 1 if self.kind == 'ga' or self.kind == 'rgba' else n
+        alpha = source.kind == 'ga' or source.kind == 'rgba'
+        level = int(opacity*255 + 0.5)
+        if level < 0 or level > 255:
+            raise ValueError('Invalid opacity.')
+        width = max(0, min(w, w - x, sw, sw + x))
+        height = max(0, min(h, h - y, sh, sh + y))
+        left, top, x, y = max(0, -x), max(0, -y), max(0, x), max(0, y)
+        if width == 0 or height == 0:
+            return self
+        if numpy:
+            d = numpy.frombuffer(self.data, numpy.uint8).reshape(h, w, n)[y:y + height, x:x + width]
+            s = numpy.frombuffer(source.data, numpy.uint8).reshape(sh, sw, m)
+            s = s[top:top + height, left:left + width].astype(numpy.int32)
+            e = d.astype(numpy.int32)
+            u = (s[:, :, -1:]*level + 127)//255 if alpha else level
+            if colors == n:
+                d[:] = (s[:, :, :n]*u + e*(255 - u) + 127)//255
+            else:
+                v = (e[:, :, -1:]*(255 - u) + 127)//255
+                d[:, :, :-1] = (s[:, :, :colors]*u + e[:, :, :-1]*v + 127)//255
+                d[:, :, -1:] = u + v
+            return self
+        # Whole rows at a time, multiplied and divided through tables.
+        products, quotients = _products.__getitem__, _quotients.__getitem__
+        table = bytes((a*level + 127)//255 for a in range(256))
+        for k in range(height):
+            i = (x + (y + k)*w)*n
+            j = (left + (top + k)*sw)*m
+            d = bytearray(self.data[i:i + width*n])
+            s = bytes(source.data[j:j + width*m])
+            u = s[m - 1::m].translate(table) if alpha else bytes((level,))*width
+            v = u.translate(_inversion)
+            if colors != n:
+                v = bytes(map(quotients, map(products,
+                    map(add, map(mul, v, repeat(256)), d[n - 1::n]))))
+                d[n - 1::n] = bytes(map(add, u, v))
+            u = list(map(mul, u, repeat(256)))
+            v = list(map(mul, v, repeat(256)))
+            for c in range(colors):
+                d[c::n] = bytes(map(quotients, map(add,
+                    map(products, map(add, u, s[c::m])),
+                    map(products, map(add, v, d[c::n])))))
+            self.data[i:i + width*n] = d
+        return self
+    
     def crop(self, x, y, width, height):
         self.decompress()
         w, h, n = self.width, self.height, self.n
         width = max(0, min(w, w - x, width, width + x))
         height = max(0, min(h, h - y, height, height + y))
-        if w != width:
-            for k in range(height):
-                i = (0 + (0 + k)*width)*n
-                j = (max(0, x) + (max(0, y) + k)*w)*n
-                self.data[i:i + width*n] = self.data[j:j + width*n]
-        self.data[width*height*n:] = []
+        if w != width or h != height:
+            # A new buffer, as the current one may be shared and cannot
+            # change size.
+            data = self.data
+            self.data = bytearray().join(
+                data[i:i + width*n] for i in (
+                    (max(0, x) + (max(0, y) + k)*w)*n for k in range(height)))
         self.width, self.height = width, height
         return self
     
+    def region(self, x, y, width, height):
+        # Decodes no more of the source than needed: PNG up to the last
+        # row of the region, JPEG in the rows of MCUs overlapping it.
+        # Pixels decoded already are sliced as they are.
+        w, h, n, source = self.width, self.height, self.n, self.source
+        width = max(0, min(w, w - x, width, width + x))
+        height = max(0, min(h, h - y, height, height + y))
+        x, y = max(0, x), max(0, y)
+        i = image(width, height, self.kind)
+        if width and height and source and id(self) not in _decoded:
+            if isinstance(source, png):
+                i.data[:] = bytearray().join(row[x*n:(x + width)*n]
+                    for row in islice(source.rows(), y, y + height))
+                return i
+            if isinstance(source, jpeg) and source.rotation == 0:
+                i.data[:] = bytearray().join(source.bands(x, y, width, height))
+                return i
+        data = self._read().data
+        i.data[:] = bytearray().join(data[j:j + width*n] for j in (
+            (x + (y + k)*w)*n for k in range(height)))
+        return i
+    
     def flip(self, horizontal, vertical):
         self.decompress()
         w, h, n, data = self.width, self.height, self.n, self.data
-        if horizontal and vertical:
-            for y in range(h//2):
-                for x in range(w):
-                    i = (x + y*w)*n
-                    j = ((w - x - 1) + (h - y - 1)*w)*n
-                    k = n
-                    while k > 0:
-                        data[i], data[j] = data[j], data[i]
-                        i += 1
-                        j += 1
-                        k -= 1
-            if h%2 == 1:
-                m = h//2
-                for x in range(w//2):
-                    i = (x + m*w)*n
-                    j = ((w - x - 1) + m*w)*n
-                    k = n
-                    while k > 0:
-                        data[i], data[j] = data[j], data[i]
-                        i += 1
-                        j += 1
-                        k -= 1
-        elif horizontal:
-            for y in range(h):
-                for x in range(w//2):
-                    i = (x + y*w)*n
-                    j = ((w - x - 1) + y*w)*n
-                    k = n
-                    while k > 0:
-                        data[i], data[j] = data[j], data[i]
-                        i += 1
-                        j += 1
-                        k -= 1
-        elif vertical:
-            for y in range(h//2):
-                for x in range(w):
-                    i = (x + y*w)*n
-                    j = (x + (h - y - 1)*w)*n
-                    k = n
-                    while k > 0:
-                        data[i], data[j] = data[j], data[i]
-                        i += 1
-                        j += 1
-                        k -= 1
+        if not horizontal and not vertical:
+            return self
+        if numpy:
+            pixels = numpy.frombuffer(data, numpy.uint8).reshape(h, w, n)
+            if horizontal:
+                pixels = pixels[:, ::-1]
+            if vertical:
+                pixels = pixels[::-1]
+            data[:] = pixels.tobytes()
+            return self
+        if horizontal:
+            # Reversing all bytes flips both ways and reverses the order
+            # of components, which the strided copies put back.
+            reverse = data[::-1]
+            for k in range(n):
+                data[k::n] = reverse[n-k-1::n]
+        if horizontal != vertical:
+            wn = w*n
+            data[:] = b''.join(data[y*wn:(y + 1)*wn] for y in range(h - 1, -1, -1))
         return self
     
     def transpose(self):
         self.decompress()
         w, h, n, data = self.width, self.height, self.n, self.data
-        if w == h:
-            for y in range(h - 1):
-                for x in range(y + 1, w):
-                    i = (x + y*w)*n
-                    j = (y + x*h)*n
-                    k = n
-                    while k > 0:
-                        data[i], data[j] = data[j], data[i]
-                        i += 1
-                        j += 1
-                        k -= 1
-            return self
-        result = bytearray(w*h*n)
-        for y in range(h):
-            for x in range(w):
-                i = (x + y*w)*n
-                j = (y + x*h)*n
-                k = n
-                while k > 0:
-                    result[j] = data[i]
-                    i += 1
-                    j += 1
-                    k -= 1
+        if numpy:
+            pixels = numpy.frombuffer(data, numpy.uint8).reshape(h, w, n)
+            result = pixels.transpose(1, 0, 2).tobytes()
+        else:
+            result = bytearray(w*h*n)
+            for y in range(h):
+                for k in range(n):
+                    result[y*n+k::h*n] = data[y*w*n+k:(y + 1)*w*n:n]
         self.width, self.height = h, w
         self.data[:] = result
         return self
@@ -295,107 +612,92 @@ class image(object):
     def rotate(self, clockwise):
         self.decompress()
         w, h, n, data = self.width, self.height, self.n, self.data
-        if w == h:
-            for y in range(h//2):
-                for x in range(y, w - y - 1):
-                    i = (x + y*w)*n
-                    j = ((w - y - 1) + x*w)*n
-                    k = ((w - x - 1) + (h - y - 1)*w)*n
-                    l = (y + (h - x - 1)*w)*n
-                    m = n
-                    while m > 0:
-                        t = data[i]
-                        if clockwise:
-                            data[i] = data[l]
-                            data[l] = data[k]
-                            data[k] = data[j]
-                            data[j] = t
-                        else:
-                            data[i] = data[j]
-                            data[j] = data[k]
-                            data[k] = data[l]
-                            data[l] = t
-                        i += 1
-                        j += 1
-                        k += 1
-                        l += 1
-                        m -= 1
-            return self
-        result = bytearray(w*h*n)
-        for y in range(h):
-            for x in range(w):
-                i = (x + y*w)*n
-                if clockwise:
-                    j = (h - y - 1 + x*h)*n
-                else:
-                    j = (y + (w - x - 1)*h)*n
-                k = n
-                while k > 0:
-                    result[j] = data[i]
-                    i += 1
-                    j += 1
-                    k -= 1
+        if numpy:
+            pixels = numpy.frombuffer(data, numpy.uint8).reshape(h, w, n)
+            result = numpy.rot90(pixels, -1 if clockwise else 1).tobytes()
+        else:
+            result = bytearray(w*h*n)
+            for y in range(h):
+                for k in range(n):
+                    row = data[y*w*n+k:(y + 1)*w*n:n]
+                    if clockwise:
+                        result[(h - y - 1)*n+k::h*n] = row
+                    else:
+                        result[y*n+k::h*n] = row[::-1]
         self.width, self.height = h, w
         self.data[:] = result
         return self
     
     def resize(self, width=0, height=0, interpolation='bicubic'):
         self.decompress()
-        if interpolation == 'nearest':
-            kernel, support = nearest_kernel, 0.5
-        elif interpolation == 'bicubic':
-            kernel, support = _bicubic_kernel, 2.0
-        elif interpolation == 'lanczos':
-            kernel, support = _lanczos_kernel, 5.0
-        else:
-            raise ValueError('Invalid interpolation.')
+        kernel, support = _interpolation(interpolation)
         w, h, n, data = self.width, self.height, self.n, self.data
+        width, height = _dimensions(w, h, width, height)
         if width == w and height == h:
             return self
-        if width == 0 and height == 0:
+        if numpy:
+            # A block of destination rows at a time, from only the source
+            # rows it needs, so that the floating point values stay few.
+            source = numpy.frombuffer(data, numpy.uint8).reshape(h, w*n)
+            xtaps = [(numpy.array(indices), numpy.array(factors))
+                for indices, factors in _taps(w, width, n, kernel, support)]
+            ytaps = _taps(h, height, 1, kernel, support)
+            result = bytearray(width*height*n)
+            for top in range(0, height, 64):
+                bottom = min(height, top + 64)
+                low = ytaps[0][0][top]
+                high = max(indices[bottom - 1] for indices, _ in ytaps) + 1
+                rows = numpy.zeros((high - low, width*n))
+                for indices, factors in xtaps:
+                    rows += source[low:high, indices]*factors
+                columns = numpy.zeros((bottom - top, width*n))
+                for indices, factors in ytaps:
+                    columns += rows[numpy.array(indices[top:bottom]) - low]* \
+                        numpy.array(factors[top:bottom])[:, None]
+                columns += 0.5
+                result[top*width*n:bottom*width*n] = \
+                    numpy.clip(columns, 0, 255).astype(numpy.uint8).tobytes()
+        else:
+            result = bytearray().join(_resampling(
+                _rows([data], w*n), w, h, n, width, height, kernel, support))
+        self.width, self.height = width, height
+        self.data = result
+        return self
+    
+    def reduce(self, factor):
+        self.decompress()
+        if factor < 1 or factor != int(factor):
+            raise ValueError('Invalid factor.')
+        factor = int(factor)
+        if factor == 1:
             return self
-        if width == 0:
-            width = max(1, (height*w)//h)
-        elif height == 0:
-            height = max(1, (width*h)//w)
-        result = bytearray(width*height*n)
-        column = [0.0]*h
-        sx, sy = w/width, h/height
-        ycontributions = [_kernel_contribution(y, sy, h, kernel, support)
-            for y in range(height)]
-        for x in range(width):
-            index, xweights = _kernel_contribution(x, sx, w, kernel, support)
-            for component in range(n):
-                for y in range(h):
-                    c = 0.0
-                    i = (index + y*w)*n + component
-                    for weight in xweights:
-                        c += data[i]*weight
-                        i += n
-                    column[y] = c
-                for y in range(height):
-                    c = 0.0
-                    i, yweights = ycontributions[y]
-                    for weight in yweights:
-                        c += column[i]*weight
-                        i += 1
-                    if c < 0.5:
-                        value = 0
-                    elif c >= 254.5:
-                        value = 255
-                    else:
-                        value = int(c + 0.5)
-                    i = (x + y*width)*n + component
-                    result[i] = value
+        w, h, n, data = self.width, self.height, self.n, self.data
+        width, height = -(-w//factor), -(-h//factor)
+        if numpy:
+            cw, ch = w - (width - 1)*factor, h - (height - 1)*factor
+            source = numpy.frombuffer(data, numpy.uint8).reshape(h, w, n)
+            sums = numpy.add.reduceat(source, range(0, h, factor), 0, numpy.uint32)
+            sums = numpy.add.reduceat(sums, range(0, w, factor), 1)
+            counts = numpy.full((height, width, 1), factor*factor, numpy.uint32)
+            counts[-1] = ch*factor
+            counts[:, -1] = factor*cw
+            counts[-1, -1] = ch*cw
+            result = bytearray(((sums + counts//2)//counts).astype(numpy.uint8).tobytes())
+        else:
+            result = bytearray().join(_reduction(_rows([data], w*n), w, h, n, factor))
         self.width, self.height = width, height
-        self.data[:] = result
+        self.data = result
         return self
     
     def rescale(self, factor, interpolation='bicubic'):
         w, h = int(self.width*factor+0.5), int(self.height*factor+0.5)
         return self.resize(w, h, interpolation)
     
-    def blur(self, radius):
+    def blur(self, radius, kernel='binomial'):
+        if kernel == 'box':
+            return self._box_blur(radius)
+        if kernel != 'binomial':
+            raise ValueError('Invalid kernel.')
         self.decompress()
         kernel = [1]*(radius*2 + 1)
         for k in range(radius*2 - 1):
@@ -430,14 +732,57 @@ class image(object):
                     data[i] = (value + total//2)//total
         return self
     
-    def dither(self, levels=2):
+    def _box_blur(self, radius):
+        self.decompress()
+        w, h, n, data = self.width, self.height, self.n, self.data
+        # Three running sums in place of the binomial kernel of the same
+        # variance, radius/2, each pass costing the same for any radius.
+        radii = [r for r in _box_radii(radius/2.0) if r > 0]
+        if numpy:
+            pixels = numpy.frombuffer(data, numpy.uint8).reshape(h, w, n).astype(numpy.int64)
+            for axis, length in ((1, w), (0, h)):
+                shape = (1, -1, 1) if axis == 1 else (-1, 1, 1)
+                for r in radii:
+                    lows = [max(0, i - r) for i in range(length)]
+                    highs = [min(length, i + r + 1) for i in range(length)]
+                    counts = numpy.reshape(numpy.subtract(highs, lows), shape)
+                    sums = numpy.cumsum(pixels, axis)
+                    sums = numpy.concatenate((numpy.zeros_like(sums.take([0], axis)), sums), axis)
+                    pixels = (sums.take(highs, axis) - sums.take(lows, axis) + \
+                        counts//2)//counts
+            data[:] = pixels.astype(numpy.uint8).tobytes()
+            return self
+        rows = [_box(w, r) for r in radii] if w > 1 else []
+        for y in range(h):
+            for component in range(n):
+                i, j = y*w*n + component, (y + 1)*w*n
+                values = data[i:j:n]
+                for lows, highs, counts, halves in rows:
+                    values = _box_line(values, lows, highs, counts, halves)
+                data[i:j:n] = values
+        columns = [_box(h, r) for r in radii] if h > 1 else []
+        for i in range(w*n):
+            values = data[i::w*n]
+            for lows, highs, counts, halves in columns:
+                values = _box_line(values, lows, highs, counts, halves)
+            data[i::w*n] = values
+        return self
+    
+    def dither(self, levels=2, method='burkes'):
         self.decompress()
-        # Error diffusion dithering weights by Burkes, D. (1988).
         if self.kind != 'g':
             raise ValueError('Invalid image kind.')
         if levels < 2 or levels > 256:
             raise ValueError('Invalid levels count.')
         w, h, data = self.width, self.height, self.data
+        if method == 'bayer':
+            tables = _ordering(levels)
+            for y in range(h):
+                data[y*w:(y + 1)*w] = _ordered(data[y*w:(y + 1)*w], y, tables)
+            return self
+        if method != 'burkes':
+            raise ValueError('Invalid dithering method.')
+        # Error diffusion dithering weights by Burkes, D. (1988).
         cache = [255*(i*levels//256)//(levels - 1) for i in range(256)]
         errors = [0]*(w + 4)
         for y in range(h):
@@ -457,32 +802,112 @@ class image(object):
                 errors[x + 4] = 2*error
         return self
     
-    def gamma(self, value):
+    def lookup(self, table):
         self.decompress()
+        table = bytes(table)
+        if len(table) != 256:
+            raise ValueError('Invalid table length.')
         data = self.data
-        cache = [int((i/255.0)**value*255.0 + 0.5) for i in range(256)]
-        for i in range(self.width*self.height*self.n):
-            data[i] = cache[data[i]]
+        if not isinstance(data, bytearray):
+            data = bytes(data)
+        self.data[:] = data.translate(table)
         return self
     
+    def gamma(self, value):
+        return self.lookup(_gamma_table(value))
+    
     def invert(self):
+        return self.lookup(_inversion)
+    
+    def convert(self, kind, background=None):
         self.decompress()
-        data = self.data
-        for i in range(self.width*self.height*self.n):
-            data[i] ^= 255
+        if kind == self.kind:
+            return self
+        w, h, n, data = self.width, self.height, self.n, self.data
+        m = image(0, 0, kind).n
+        if numpy:
+            pixels = numpy.frombuffer(data, numpy.uint8).reshape(w*h, n).astype(numpy.int32)
+            channels = [pixels[:, k] for k in range(n)]
+        else:
+            if not isinstance(data, bytearray):
+                data = bytes(data)
+            channels = [data[k::n] for k in range(n)]
+        alpha = channels.pop() if self.kind == 'ga' or self.kind == 'rgba' else None
+        if kind == 'ga' or kind == 'rgba':
+            colors = m - 1
+        else:
+            colors = m
+            if alpha is not None:
+                if background is None:
+                    background = (255,)*len(channels)
+                if len(background) != len(channels):
+                    raise ValueError('Different component count.')
+                if numpy:
+                    channels = [(c*alpha + b*(255 - alpha) + 127)//255
+                        for c, b in zip(channels, background)]
+                else:
+                    offsets = list(map(mul, alpha, repeat(256)))
+                    channels = [bytes(map(_over(b).__getitem__, map(add, offsets, c)))
+                        for c, b in zip(channels, background)]
+                alpha = None
+        if len(channels) == 4 and colors != 4: # cmyk to rgb
+            k = channels.pop()
+            if numpy:
+                channels = [255 - numpy.minimum(c + k, 255) for c in channels]
+            else:
+                channels = [bytes(map(min, repeat(255), map(add, c, k))).translate(_inversion)
+                    for c in channels]
+        if len(channels) == 3 and colors == 1: # rgb to g
+            r, g, b = channels
+            if numpy:
+                channels = [(19595*r + 38470*g + 7471*b + 32768) >> 16]
+            else:
+                channels = [bytes(map(rshift, map(add, map(add,
+                    map(_red.__getitem__, r), map(_green.__getitem__, g)),
+                    map(_blue.__getitem__, b)), repeat(16)))]
+        elif len(channels) == 1 and colors != 1: # g to rgb
+            channels = channels*3
+        if len(channels) == 3 and colors == 4: # rgb to cmyk, all gray in black
+            if numpy:
+                maximum = numpy.maximum(numpy.maximum(channels[0], channels[1]), channels[2])
+                channels = [maximum - c for c in channels] + [255 - maximum]
+            else:
+                maximum = bytes(map(max, *channels))
+                channels = [bytes(map(sub, maximum, c)) for c in channels] + \
+                    [maximum.translate(_inversion)]
+        if m != colors:
+            if alpha is None:
+                alpha = numpy.full(w*h, 255) if numpy else b'\xff'*(w*h)
+            channels.append(alpha)
+        if numpy:
+            result = numpy.stack(channels, 1).astype(numpy.uint8).tobytes()
+        else:
+            result = bytearray(w*h*m)
+            for k in range(m):
+                result[k::m] = channels[k]
+        if m == n:
+            self.data[:] = result
+        else:
+            # A new buffer, as the current one may be shared and cannot
+            # change size.
+            self.data = bytearray(result)
+        self.kind, self.n = kind, m
         return self
     
+    def ops(self):
+        return operations(self)
+    
     def jpeg(self, path='', quality=95):
         if isinstance(self.source, jpeg):
-            return save(path, self.source.readable.data)
-        self.decompress()
+            return save(path, bytes(self.source.readable.data))
+        self._read()
         data = jpegserialize(self, quality)
         return save(path, data)
     
     def png(self, path='', optimized=False):
         if isinstance(self.source, png):
-            return save(path, self.source.readable.data)
-        self.decompress()
+            return save(path, bytes(self.source.readable.data))
+        self._read()
         data = pngserialize(self, optimized)
         return save(path, data)
     
@@ -492,15 +917,228 @@ class image(object):
 
 
 
+class operations(object):
+    
+    __slots__ = 'image', 'steps'
+    
+    def __init__(self, image):
+        self.image = image
+        self.steps = []
+    
+    def lookup(self, table):
+        table = bytes(table)
+        if len(table) != 256:
+            raise ValueError('Invalid table length.')
+        steps = self.steps
+        if steps and steps[-1][0] == 'lookup':
+            # Consecutive tables compose into one.
+            steps[-1] = 'lookup', (steps[-1][1][0].translate(table),)
+        else:
+            steps.append(('lookup', (table,)))
+        return self
+    
+    def gamma(self, value):
+        return self.lookup(_gamma_table(value))
+    
+    def invert(self):
+        return self.lookup(_inversion)
+    
+    def fill(self, components):
+        self.steps.append(('fill', (components,)))
+        return self
+    
+    def crop(self, x, y, width, height):
+        self.steps.append(('crop', (x, y, width, height)))
+        return self
+    
+    def flip(self, horizontal, vertical):
+        self.steps.append(('flip', (horizontal, vertical)))
+        return self
+    
+    def transpose(self):
+        self.steps.append(('transpose', ()))
+        return self
+    
+    def rotate(self, clockwise):
+        self.steps.append(('rotate', (clockwise,)))
+        return self
+    
+    def resize(self, width=0, height=0, interpolation='bicubic'):
+        self.steps.append(('resize', (width, height, interpolation)))
+        return self
+    
+    def rescale(self, factor, interpolation='bicubic'):
+        self.steps.append(('rescale', (factor, interpolation)))
+        return self
+    
+    def reduce(self, factor):
+        self.steps.append(('reduce', (factor,)))
+        return self
+    
+    def blur(self, radius, kernel='binomial'):
+        self.steps.append(('blur', (radius, kernel)))
+        return self
+    
+    def dither(self, levels=2, method='burkes'):
+        self.steps.append(('dither', (levels, method)))
+        return self
+    
+    def convert(self, kind, background=None):
+        self.steps.append(('convert', (kind, background)))
+        return self
+    
+    def run(self):
+        i = self.image.decompress()
+        for name, arguments in self.steps:
+            getattr(i, name)(*arguments)
+        self.steps = []
+        return i
+    
+    def _stream(self):
+        # Tables, ordered dithering, resizing and reduction work on a few
+        # rows at a time, straight from the decoder if the image is not
+        # decoded yet. Anything else is done on a copy of the whole image
+        # first.
+        i, steps = self.image, self.steps
+        self.steps = []
+        source = i.source
+        if isinstance(source, jpeg) and source.rotation != 0 or \
+            any(name not in ('lookup', 'resize', 'rescale', 'reduce') and \
+                (name != 'dither' or arguments[1] != 'bayer') for name, arguments in steps):
+            i = i.copy().decompress()
+            for name, arguments in steps:
+                getattr(i, name)(*arguments)
+            steps, source = [], None
+        w, h, n = i.width, i.height, i.n
+        if isinstance(source, png):
+            rows = source.rows()
+        elif isinstance(source, jpeg):
+            rows = _rows(source.bands(), w*n)
+        else:
+            rows = _rows([i.data], w*n)
+        for name, arguments in steps:
+            if name == 'lookup':
+                rows = map(bytes.translate, map(bytes, rows), repeat(arguments[0]))
+            elif name == 'dither':
+                levels = arguments[0]
+                if i.kind != 'g':
+                    raise ValueError('Invalid image kind.')
+                if levels < 2 or levels > 256:
+                    raise ValueError('Invalid levels count.')
+                rows = map(_ordered, rows, count(), repeat(_ordering(levels)))
+            elif name == 'reduce':
+                factor = arguments[0]
+                if factor < 1 or factor != int(factor):
+                    raise ValueError('Invalid factor.')
+                factor = int(factor)
+                if factor > 1:
+                    rows = _reduction(rows, w, h, n, factor)
+                    w, h = -(-w//factor), -(-h//factor)
+            else:
+                if name == 'rescale':
+                    factor, interpolation = arguments
+                    width, height = int(w*factor+0.5), int(h*factor+0.5)
+                else:
+                    width, height, interpolation = arguments
+                kernel, support = _interpolation(interpolation)
+                width, height = _dimensions(w, h, width, height)
+                if width != w or height != h:
+                    rows = _resampling(rows, w, h, n, width, height, kernel, support)
+                    w, h = width, height
+        return w, h, i.kind, rows
+    
+    def rows(self):
+        return self._stream()[3]
+    
+    def png(self, path, optimized=False):
+        w, h, kind, rows = self._stream()
+        bands = (image.frombuffer(w, 1, kind, row) for row in rows)
+        with open(path, 'wb') as f:
+            pngstream(f, w, h, kind, bands, optimized)
+    
+    def jpeg(self, path, quality=95):
+        w, h, kind, rows = self._stream()
+        with open(path, 'wb') as f:
+            jpegstream(f, w, h, kind, rows, quality)
+
+
+
+
+_budget = 256*1024*1024
+_decoded = OrderedDict()
+_decoded_size = 0
+
+
+def _forget(key):
+    global _decoded_size
+    if key in _decoded:
+        _decoded_size -= _decoded.pop(key)[1]
+
+def _evict():
+    # The most recently used pixels stay, even over budget.
+    while _decoded_size > _budget and len(_decoded) > 1:
+        key = next(iter(_decoded))
+        item = _decoded[key][0]()
+        _forget(key)
+        if item is not None:
+            item.data = bytearray()
+
+def _remember(item):
+    global _decoded_size
+    key = id(item)
+    _forget(key)
+    _decoded[key] = ref(item, lambda _, key=key: _forget(key)), len(item.data)
+    _decoded_size += len(item.data)
+    _evict()
+
+
+
+
+_capacity = 64*1024*1024
+_resized = OrderedDict()
+_size = 0
+
+
+def _unresize(key, reference):
+    global _size
+    if key in _resized and _resized[key][0] is reference:
+        _size -= len(_resized.pop(key)[2].data)
+
+def _resize(item, width, height, interpolation):
+    # Resized copies are looked up by the image and validated by its
+    # undecoded source or, once decoded, by a checksum of its pixels.
+    # Both the image and its source are only weakly referenced, so that
+    # the capacity bounds all that is kept alive.
+    global _size
+    key = id(item), width, height, interpolation
+    source = item.source
+    checksum = None if source else crc32(item.data)
+    if key in _resized:
+        cached, validation, result = _resized[key]
+        if cached() is item and (validation() is source if source else validation == checksum):
+            _resized.move_to_end(key)
+            return result
+        _size -= len(_resized.pop(key)[2].data)
+    result = item.copy().resize(width, height, interpolation)
+    if len(result.data) <= _capacity//4:
+        validation = ref(source) if source else checksum
+        _resized[key] = ref(item, lambda r, key=key: _unresize(key, r)), validation, result
+        _size += len(result.data)
+        while _size > _capacity:
+            _, (_, _, evicted) = _resized.popitem(False)
+            _size -= len(evicted.data)
+    return result
+
 class placedimage(object):
     
-    __slots__ = 'item', 'k', 'x', 'y', 'width', 'height'
+    __slots__ = 'item', 'k', 'x', 'y', 'width', 'height', 'interpolation'
     
     def __init__(self, item, k):
         self.item = item
         self.k = k
         self.x, self.y = 0.0, 0.0
         self.width, self.height = item.width, item.height
+        self.interpolation = 'bicubic'
     
     def position(self, x, y):
         self.x, self.y = x*self.k, y*self.k
@@ -523,6 +1161,12 @@ class placedimage(object):
             height*image.width/image.height*self.k, height*self.k
         return self
     
+    def interpolate(self, interpolation):
+        if interpolation not in ('nearest', 'bicubic', 'lanczos'):
+            raise ValueError('Invalid interpolation.')
+        self.interpolation = interpolation
+        return self
+    
     def pdf(self, height, state, resources):
         x, y = self.x, height-self.y-self.height
         w, h = self.width, self.height
@@ -557,20 +1201,35 @@ class placedimage(object):
                 dump(self.width), dump(self.height), ratio,
                 mime, b64encode(data))
     
+    def bounds(self, k, x, y):
+        x, y = int(round(self.x*k + x)), int(round(self.y*k + y))
+        w, h = int(self.width*k + 0.5), int(self.height*k + 0.5)
+        return x, y, x + w, y + h
+    
     def rasterize(self, rasterizer, k, x, y):
         x, y = int(round(self.x*k + x)), int(round(self.y*k + y))
         w, h = int(self.width*k + 0.5), int(self.height*k + 0.5)
-        source = self.item.copy().resize(w, h)
-        rasterizer.image.blit(x, y, source)
+        if self.interpolation == 'nearest':
+            rasterizer.sample(x, y, w, h, self.item._read())
+        else:
+            rasterizer.blit(x, y, _resize(self.item, w, h, self.interpolation))
+
 
 
 
+def _luminances(pixels):
+    if numpy:
+        return pixels[:, 0]*0.212671 + pixels[:, 1]*0.71516 + pixels[:, 2]*0.072169
+    return list(map(add, map(add,
+        map(mul, pixels[0::3], repeat(0.212671)),
+        map(mul, pixels[1::3], repeat(0.71516))),
+        map(mul, pixels[2::3], repeat(0.072169))))
 
 class raw(object):
     
     def __init__(self, width, height):
         self.width, self.height = width, height
-        self.data = [0.0]*width*height*3
+        self.data = array('d', [0.0])*(width*height*3)
     
     def put(self, x, y, r, g, b):
         data = self.data
@@ -581,23 +1240,41 @@ class raw(object):
     def tonemapped(self, key=0.18, white=1.0):
         # Ref.: Reinhard, E., Stark, M., Shirley, P., Ferwerda, J. (2002).
         # Photographic Tone Reproduction for Digital Images.
+        # A band of pixels at a time, so that the intermediate values
+        # take little memory.
         w, h, data = self.width, self.height, self.data
+        if numpy:
+            data = numpy.frombuffer(data, numpy.float64).reshape(w*h, 3)
+        step = 65536
         total = 0.0
-        for i in range(0, w*h*3, 3):
-            r, g, b = data[i], data[i+1], data[i+2]
-            l = r*0.212671 + g*0.71516 + b*0.072169
-            total += log(max(1e-10, l))
+        for i in range(0, w*h, step):
+            if numpy:
+                l = _luminances(data[i:i + step])
+                total += float(numpy.log(numpy.maximum(1e-10, l)).sum())
+            else:
+                l = _luminances(data[i*3:(i + step)*3])
+                total += sum(map(log, map(max, repeat(1e-10), l)))
         average = exp(total/(w*h))
         scale = key/average
         iwhite2 = 1.0/(white*white)
         other = image(w, h, 'rgb')
         otherdata = other.data
-        for i in range(0, w*h*3, 3):
-            r, g, b = data[i], data[i+1], data[i+2]
-            l = scale*(r*0.212671 + g*0.71516 + b*0.072169)
-            d = scale*(1.0 + l*iwhite2)/(1.0 + l)
-            for j in range(i, i + 3):
-                otherdata[j] = min(int((data[j]*d)**0.45*255.0 + 0.5), 255)
+        for i in range(0, w*h, step):
+            if numpy:
+                pixels = data[i:i + step]
+                l = scale*_luminances(pixels)
+                d = scale*(1.0 + l*iwhite2)/(1.0 + l)
+                values = numpy.minimum((pixels*d[:, None])**0.45*255.0 + 0.5, 255.0)
+                otherdata[i*3:(i + step)*3] = values.astype(numpy.uint8).tobytes()
+            else:
+                pixels = data[i*3:(i + step)*3]
+                l = list(map(mul, repeat(scale), _luminances(pixels)))
+                d = list(map(truediv,
+                    map(mul, repeat(scale), map(add, repeat(1.0), map(mul, l, repeat(iwhite2)))),
+                    map(add, repeat(1.0), l)))
+                for k in range(3):
+                    otherdata[i*3 + k:(i + step)*3:3] = _quantize(map(mul,
+                        map(pow, map(mul, pixels[k::3], d), repeat(0.45)), repeat(255.0)))
         return other
 
 
@@ -1,5 +1,5 @@
 from array import array
-from struct import pack
+from struct import pack, unpack
 from .readable import readable
 from .misc import clamp
 
@@ -359,6 +359,18 @@ def _parse_app14(readable):
     transform = readable.uint8()
     return transform
 
+def _restart_position(data, position, count):
+    # Just after the count-th RST marker, skipping the entropy-coded
+    # data before it.
+    while count > 0:
+        position = data.find(b'\xff', position) + 1
+        if position == 0:
+            raise ValueError('Missing RST marker.')
+        if 0xd0 <= data[position] <= 0xd7:
+            position += 1
+            count -= 1
+    return position
+
 class _frame_component(object):
     
     __slots__ = 'identifier', 'h', 'v', 'destination'
@@ -440,7 +452,7 @@ class _entropy_decoder(object):
             return value - (1 << length) + 1
         return value
     
-    def decode(self, previous, block, q, dc, ac):
+    def decode(self, previous, block, q, dc, ac, inverse=True):
         i = 0
         while i < 64:
             block[i] = block[i + 1] = block[i + 2] = block[i + 3] = 0
@@ -462,7 +474,8 @@ class _entropy_decoder(object):
                 i += r
                 block[_z_z[i]] = self.receiveextend(s)
                 i += 1
-        _inverse_dct(block, q)
+        if inverse:
+            _inverse_dct(block, q)
         return previous
 
 
@@ -555,7 +568,8 @@ class _entropy_encoder(object):
         self.length = length
     
     def dump(self):
-        return self.data
+        data, self.data = self.data, bytearray()
+        return data
 
 
 
@@ -564,7 +578,7 @@ class jpeg(object):
     
     @staticmethod
     def valid(data):
-        return data.startswith(b'\xff\xd8\xff')
+        return data[:3] == b'\xff\xd8\xff'
     
     def __init__(self, data):
         self.readable = r = readable(data)
@@ -626,7 +640,11 @@ class jpeg(object):
                     raise ValueError('Expand reference component(s) not supported.')
                 raise ValueError('Unsupported marker.')
     
-    def decompress(self):
+    def bands(self, x=0, y=0, width=0, height=0):
+        # Each row of MCUs is converted into a band of its own, so that
+        # only one is held in memory. Given a region, the MCUs outside of
+        # it are only entropy-decoded, the ones past it not at all, and
+        # whole restart intervals before it are skipped.
         if not self.components:
             raise ValueError('Missing SOF segment.')
         if not self.scans:
@@ -637,11 +655,14 @@ class jpeg(object):
             raise ValueError('Missing DHT segment.')
         if self.progressive:
             raise ValueError('Progressive DCT not supported.')
-        self.readable.jump(self.ecs)
+        # A cursor of its own, the source may be read again meanwhile.
+        r = readable(self.readable.data)
+        r.jump(self.ecs)
         w, h, n = self.width, self.height, self.n
+        width, height = width or w - x, height or h - y
+        right, bottom = x + width, y + height
         interval, transform = self.interval, self.transform
-        d = _entropy_decoder(self.readable)
-        data = bytearray(w*h*n)
+        d = _entropy_decoder(r)
         predictions = [0, 0, 0, 0]
         ublock, vblock, kblock = [0]*64, [0]*64, [0]*64
         yblocks = [0]*64, [0]*64, [0]*64, [0]*64
@@ -653,26 +674,42 @@ class jpeg(object):
         acs = [self.htables[self.scans[c.identifier].ac] for c in self.components]
         h0, v0 = hs[0], vs[0]
         hb, vb = h0.bit_length()-1, v0.bit_length()-1
-        count = 0
+        mw, mh = 8*h0, 8*v0
+        columns, rows = (w + mw - 1)//mw, (h + mh - 1)//mh
+        count = index = 0
         if interval == 0:
-            interval = ((w + 8*h0 - 1)//(8*h0))*((h + 8*v0 - 1)//(8*v0))
-        for y in range(0, h, 8*v0):
-            for x in range(0, w, 8*h0):
+            interval = columns*rows
+        elif (y//mh)*columns >= interval:
+            k = (y//mh)*columns//interval
+            r.jump(_restart_position(r.data, self.ecs, k))
+            d.rst = k & 7
+            index = k*interval
+        for row in range(index//columns, (bottom + mh - 1)//mh):
+            oy = row*mh
+            top = max(oy, y)
+            inside = oy + mh > y
+            if inside:
+                data = bytearray((min(oy + mh, bottom) - top)*width*n)
+            for column in range(index%columns if row == index//columns else 0, columns):
+                ox = column*mw
                 count += 1
                 if count > interval:
                     d.restart()
                     predictions[:] = [0, 0, 0, 0]
                     count = 1
+                convert = inside and ox < right and ox + mw > x
                 for i in range(n):
                     for j in range(hs[i]*vs[i]):
-                        predictions[i] = d.decode(predictions[i], blocks[i][j], qs[i], dcs[i], acs[i])
+                        predictions[i] = d.decode(predictions[i], blocks[i][j], qs[i], dcs[i], acs[i], convert)
+                if not convert:
+                    continue
                 for sy in range(v0):
                     for sx in range(h0):
                         yblock = yblocks[sx + sy*h0]
-                        for by in range(min(8, h - y - sy*8)):
-                            for bx in range(min(8, w - x - sx*8)):
+                        for by in range(max(0, y - oy - sy*8), min(8, bottom - oy - sy*8)):
+                            for bx in range(max(0, x - ox - sx*8), min(8, right - ox - sx*8)):
                                 i = ((sx*8 + bx) >> hb) + ((sy*8 + by) >> vb)*8
-                                j = (x + sx*8 + bx + (y + sy*8 + by)*w)*n
+                                j = (ox + sx*8 + bx - x + (oy + sy*8 + by - top)*width)*n
                                 if n == 1:
                                     data[j] = clamp(yblock[i] + 128)
                                 elif n == 3:
@@ -694,17 +731,44 @@ class jpeg(object):
                                         data[j + 1] = clamp(u + 128)
                                         data[j + 2] = clamp(v + 128)
                                         data[j + 3] = clamp(k + 128)
-        if not self.readable.peek(b'\xff\xd9'): # EOI
+            if inside:
+                yield data
+        if (bottom + mh - 1)//mh == rows and not r.peek(b'\xff\xd9'): # EOI
             raise ValueError('Missing EOI segment.')
-        return data
+    
+    def decompress(self):
+        return bytearray().join(self.bands())
 
 
 
 
-def serialize(image, quality):
-    if image.kind not in ('g', 'rgb', 'cmyk'):
-        raise ValueError('Invalid image kind.')
-    w, h, n, data = image.width, image.height, image.n, image.data
+def probe(f):
+    # Segments are read one by one up to the frame header. Of those before
+    # it, only APP1 is parsed, for rotation; the rest are skipped.
+    if f.read(2) != b'\xff\xd8': # SOI
+        raise ValueError('Invalid SOI marker.')
+    rotation = 0
+    while True:
+        marker = f.read(1)
+        if marker != b'\xff':
+            raise ValueError('Invalid marker.')
+        while marker == b'\xff':
+            marker = f.read(1)
+        if not marker or marker == b'\xd9' or marker == b'\xda': # EOI, SOS
+            raise ValueError('Missing SOF segment.')
+        length = unpack('>H', f.read(2))[0] - 2
+        if b'\xc0' <= marker <= b'\xc2': # SOF0, SOF1, SOF2
+            width, height, kind, n = _parse_sof(readable(f.read(length)), [])
+            return width, height, kind, rotation
+        if marker == b'\xe1': # APP1
+            rotation = _parse_app1(readable(f.read(length)), length, rotation)
+        else:
+            f.seek(length, 1)
+
+def _serialization(width, height, n, bands, quality):
+    # Bands of any height are regrouped into rows of blocks, each
+    # encoded and handed out as soon as it is complete.
+    w, h, wn = width, height, width*n
     ydc = udc = vdc = kdc = 0
     yblock, ublock, vblock, kblock = [0]*64, [0]*64, [0]*64, [0]*64
     lq = _quantization_table(_luminance_quantization, quality)
@@ -716,13 +780,42 @@ def serialize(image, quality):
         cd = _huffman_table(_cd_lengths, _cd_values)
         ca = _huffman_table(_ca_lengths, _ca_values)
         cs = _scale_factor(cq)
+    app = b'Adobe\0\144\200\0\0\0\0' # tag, version, flags0, flags1, transform
+    sof = b'\10' + pack('>HHB', h, w, n) + b'\1\21\0' # depth, id, sampling, qtable
+    sos = pack('B', n) + b'\1\0' # id, htable
+    dqt = b'\0' + lq
+    dht = b'\0' + _ld_lengths + _ld_values + b'\20' + _la_lengths + _la_values
+    if n == 3:
+        sof += b'\2\21\1\3\21\1'
+        sos += b'\2\21\3\21'
+        dqt += b'\1' + cq
+        dht += b'\1' + _cd_lengths + _cd_values + b'\21' + _ca_lengths + _ca_values
+    elif n == 4:
+        sof += b'\2\21\0\3\21\0\4\21\0'
+        sos += b'\2\0\3\0\4\0'
+    sos += b'\0\77\0' # start, end, approximation
+    yield b''.join([
+        b'\xff\xd8', # SOI
+        _marker_segment(b'\xee', app) if n == 4 else b'',
+        _marker_segment(b'\xdb', dqt),
+        _marker_segment(b'\xc0', sof),
+        _marker_segment(b'\xc4', dht),
+        _marker_segment(b'\xda', sos)])
     e = _entropy_encoder()
+    bands = iter(bands)
+    data = bytearray()
     for y in range(0, h, 8):
+        rows = min(8, h - y)
+        while len(data) < rows*wn:
+            band = next(bands, None)
+            if band is None:
+                raise ValueError('Missing rows.')
+            data += band
         for x in range(0, w, 8):
             i = 0
-            for yy in range(y, y + 8):
+            for yy in range(8):
                 for xx in range(x, x + 8):
-                    j = (min(xx, w - 1) + min(yy, h - 1)*w)*n
+                    j = (min(xx, w - 1) + min(yy, rows - 1)*w)*n
                     if n == 1:
                         yblock[i] = data[j]
                     elif n == 3:
@@ -744,30 +837,25 @@ def serialize(image, quality):
                 udc = e.encode(udc, ublock, ls, ld, la)
                 vdc = e.encode(vdc, vblock, ls, ld, la)
                 kdc = e.encode(kdc, kblock, ls, ld, la)
+        del data[:rows*wn]
+        yield e.dump()
     e.write(0x7f, 7) # padding
-    app = b'Adobe\0\144\200\0\0\0\0' # tag, version, flags0, flags1, transform
-    sof = b'\10' + pack('>HHB', h, w, n) + b'\1\21\0' # depth, id, sampling, qtable
-    sos = pack('B', n) + b'\1\0' # id, htable
-    dqt = b'\0' + lq
-    dht = b'\0' + _ld_lengths + _ld_values + b'\20' + _la_lengths + _la_values
-    if n == 3:
-        sof += b'\2\21\1\3\21\1'
-        sos += b'\2\21\3\21'
-        dqt += b'\1' + cq
-        dht += b'\1' + _cd_lengths + _cd_values + b'\21' + _ca_lengths + _ca_values
-    elif n == 4:
-        sof += b'\2\21\0\3\21\0\4\21\0'
-        sos += b'\2\0\3\0\4\0'
-    sos += b'\0\77\0' # start, end, approximation
-    return b''.join([
-        b'\xff\xd8', # SOI
-        _marker_segment(b'\xee', app) if n == 4 else b'',
-        _marker_segment(b'\xdb', dqt),
-        _marker_segment(b'\xc0', sof),
-        _marker_segment(b'\xc4', dht),
-        _marker_segment(b'\xda', sos),
-        e.dump(),
-        b'\xff\xd9']) # EOI
+    yield e.dump() + b'\xff\xd9' # EOI
+
+def serialize(image, quality):
+    if image.kind not in ('g', 'rgb', 'cmyk'):
+        raise ValueError('Invalid image kind.')
+    return b''.join(_serialization(
+        image.width, image.height, image.n, [image.data], quality))
+
+def stream(f, width, height, kind, bands, quality):
+    # Bands are rows of full width, in any number at a time, which add
+    # up to height.
+    if kind not in ('g', 'rgb', 'cmyk'):
+        raise ValueError('Invalid image kind.')
+    n = (1, 3, 4)[('g', 'rgb', 'cmyk').index(kind)]
+    for data in _serialization(width, height, n, bands, quality):
+        f.write(data)
 
 
 
@@ -1,4 +1,5 @@
 from . import stl
+from .misc import load
 
 
 
@@ -6,14 +7,13 @@ from . import stl
 class mesh(object):
     
     @staticmethod
-    def openstl(path):
-        with open(path, 'rb') as f:
-            data = f.read()
-            if stl.isascii(data):
-                triplets = stl.parseascii(data)
-            else:
-                triplets = stl.parse(data)
-            return mesh(triplets)
+    def openstl(path, mmap=False):
+        data = load(path, mmap)
+        if stl.isascii(data):
+            triplets = stl.parseascii(data)
+        else:
+            triplets = stl.parse(data)
+        return mesh(triplets)
     
     def __init__(self, triplets):
         self.triplets = triplets
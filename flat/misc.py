@@ -1,4 +1,5 @@
 from math import copysign
+from mmap import mmap, ACCESS_READ
 
 
 
@@ -39,6 +40,25 @@ def dump(number):
 
 
 
+class mapping(mmap):
+    # Pickled as its path and mapped again on loading, for process pools.
+    
+    def __new__(cls, path):
+        with open(path, 'rb') as f:
+            self = mmap.__new__(cls, f.fileno(), 0, access=ACCESS_READ)
+        self.path = path
+        return self
+    
+    def __reduce__(self):
+        return mapping, (self.path,)
+
+def load(path, mapped=False):
+    # Mapped files are paged in as read, not read whole.
+    if mapped:
+        return mapping(path)
+    with open(path, 'rb') as f:
+        return f.read()
+
 def save(path, data):
     if path:
         with open(path, 'wb') as f:
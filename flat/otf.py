@@ -13,13 +13,13 @@ class otf(object):
     @staticmethod
     def valid(data):
         for version in (b'\0\1\0\0', b'OTTO', b'true', b'typ1', b'ttcf'):
-            if data.startswith(version):
+            if data[:4] == version:
                 return True
         return False
     
     def __init__(self, data, index=0):
         self.readable = r = readable(data)
-        if data.startswith(b'ttcf'):
+        if data[:4] == b'ttcf':
             r.skip(4 + 4) # TTCTag, Version
             numFonts = r.uint32()
             if index >= numFonts:
@@ -29,7 +29,7 @@ class otf(object):
         self.offset = offset(r)
         self.records = [record(r) for i in range(self.offset.numTables)]
         self.records.sort(key=lambda entry: entry.tag)
-        if data.startswith(b'OTTO'):
+        if data[:4] == b'OTTO':
             self.find(b'CFF ')
             self.cff = cff(r)
         else:
@@ -59,6 +59,10 @@ class otf(object):
     def density(self):
         return self.head().unitsPerEm
     
+    def bounds(self):
+        h = self.head()
+        return h.xMin, h.yMin, h.xMax, h.yMax
+    
     def ascender(self):
         return self.os2().sTypoAscender
     
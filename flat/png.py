@@ -1,5 +1,5 @@
 from struct import Struct
-from zlib import compress, crc32, decompress
+from zlib import compress, compressobj, crc32, decompressobj
 from .readable import readable
 
 
@@ -15,10 +15,11 @@ def _paeth_predictor(a, b, c):
         return b
     return c
 
-def _adaptive_filtering(image):
+def _adaptive_filtering(image, previous=None):
     wn, n = image.width*image.n, image.n
     s, t = bytearray(wn), bytearray(wn)
-    previous = bytearray(wn)
+    if previous is None:
+        previous = bytearray(wn)
     cache = [i if i < 128 else 256-i for i in range(256)]
     content = []
     for y in range(image.height):
@@ -83,7 +84,7 @@ def _adaptive_filtering(image):
             code, scanline = b'\4', s
         
         content.append(code)
-        content.append(scanline)
+        content.append(bytes(scanline))
         previous = row
     return b''.join(content)
 
@@ -94,7 +95,7 @@ class png(object):
     
     @staticmethod
     def valid(data):
-        return data.startswith(b'\x89PNG\r\n\x1a\n')
+        return data[:8] == b'\x89PNG\r\n\x1a\n'
     
     def __init__(self, data):
         self.readable = r = readable(data)
@@ -123,82 +124,128 @@ class png(object):
         if interlace != 0:
             raise ValueError('Unsupported interlace method.')
     
-    def idat(self):
-        r = self.readable
+    def parts(self):
+        # A cursor of its own, the source may be read again meanwhile.
+        r = readable(self.readable.data)
         r.jump(8 + 4 + 4 + 13 + 4) # header, length, name, IHDR, CRC
-        parts = []
         while True:
             length, name = r.parse('>L4s')
             if name == b'IEND':
                 break
             if name == b'IDAT':
-                parts.append(r.read(length))
+                yield r.read(length)
             else:
                 r.skip(length)
             r.skip(4) # CRC
-        return b''.join(parts)
     
-    def decompress(self):
+    def idat(self):
+        return b''.join(self.parts())
+    
+    def rows(self):
+        # Decompressed a little at a time, so that only a few rows are
+        # held in memory.
         wn, n = self.width*self.n, self.n
-        content = bytearray(decompress(self.idat()))
-        if (wn + 1)*self.height != len(content):
-            raise ValueError('Invalid content length.')
-        rows = []
+        d = decompressobj()
+        content = bytearray()
         previous = bytearray(wn)
-        for y in range(self.height):
-            offset = y*(wn + 1)
-            kind = content[offset]
-            row = content[offset+1:offset+(wn + 1)]
-            if kind == 0: # none
-                pass
-            elif kind == 1: # sub
-                for i in range(n, wn):
-                    row[i] = (row[i] + row[i - n]) & 0xff
-            elif kind == 2: # up
-                for i in range(wn):
-                    row[i] = (row[i] + previous[i]) & 0xff
-            elif kind == 3: # average
-                for i in range(0, n):
-                    row[i] = (row[i] + previous[i]//2) & 0xff
-                for i in range(n, wn):
-                    row[i] = (row[i] + (row[i - n] + previous[i])//2) & 0xff
-            elif kind == 4: # paeth
-                for i in range(0, n):
-                    row[i] = (row[i] + previous[i]) & 0xff
-                for i in range(n, wn):
-                    a, b, c = row[i - n], previous[i], previous[i - n]
-                    row[i] = (row[i] + _paeth_predictor(a, b, c)) & 0xff
-            else:
-                raise ValueError('Invalid filter method.')
-            rows.append(row)
-            previous = row
-        return bytearray().join(rows)
+        y = 0
+        for part in self.parts():
+            while part:
+                content += d.decompress(part, 65536)
+                part = d.unconsumed_tail
+                while len(content) > wn and y < self.height:
+                    kind = content[0]
+                    row = content[1:wn + 1]
+                    del content[:wn + 1]
+                    _unfiltering(kind, row, previous, n, wn)
+                    yield row
+                    previous = row
+                    y += 1
+        if y != self.height or content or d.flush():
+            raise ValueError('Invalid content length.')
+    
+    def decompress(self):
+        return bytearray().join(self.rows())
 
 
 
 
+def _unfiltering(kind, row, previous, n, wn):
+    if kind == 0: # none
+        pass
+    elif kind == 1: # sub
+        for i in range(n, wn):
+            row[i] = (row[i] + row[i - n]) & 0xff
+    elif kind == 2: # up
+        for i in range(wn):
+            row[i] = (row[i] + previous[i]) & 0xff
+    elif kind == 3: # average
+        for i in range(0, n):
+            row[i] = (row[i] + previous[i]//2) & 0xff
+        for i in range(n, wn):
+            row[i] = (row[i] + (row[i - n] + previous[i])//2) & 0xff
+    elif kind == 4: # paeth
+        for i in range(0, n):
+            row[i] = (row[i] + previous[i]) & 0xff
+        for i in range(n, wn):
+            a, b, c = row[i - n], previous[i], previous[i - n]
+            row[i] = (row[i] + _paeth_predictor(a, b, c)) & 0xff
+    else:
+        raise ValueError('Invalid filter method.')
+
+def probe(f):
+    source = png(f.read(8 + 4 + 4 + 13)) # header, length, name, IHDR
+    return source.width, source.height, source.kind, 0
+
+def _filtering(image, optimized, previous=None):
+    if optimized:
+        return _adaptive_filtering(image, previous)
+    parts = []
+    wn, n = image.width*image.n, image.n
+    for y in range(image.height):
+        offset = y*wn
+        parts.append(b'\0')
+        parts.append(image.data[offset:offset+wn])
+    return b''.join(parts)
+
+def _chunk(name, data):
+    L = Struct('>L').pack # unsigned long
+    return b''.join((
+        L(len(data)), name, data, L(crc32(data, crc32(name)) & 0xffffffff)))
+
+def _header(width, height, n):
+    L = Struct('>L').pack # unsigned long
+    color = (b'\0', b'\4', b'\2', b'\6')[n - 1]
+    ihdr = L(width) + L(height) + b'\10' + color + b'\0\0\0'
+    return b'\x89PNG\r\n\x1a\n' + _chunk(b'IHDR', ihdr)
+
 def serialize(image, optimized):
     if image.kind not in ('g', 'ga', 'rgb', 'rgba'):
         raise ValueError('Invalid image kind.')
-    L = Struct('>L').pack # unsigned long
-    color = (b'\0', b'\4', b'\2', b'\6')[image.n - 1]
-    ihdr = L(image.width) + L(image.height) + b'\10' + color + b'\0\0\0'
-    if optimized:
-        content = _adaptive_filtering(image)
-    else:
-        parts = []
-        wn, n = image.width*image.n, image.n
-        for y in range(image.height):
-            offset = y*wn
-            parts.append(b'\0')
-            parts.append(image.data[offset:offset+wn])
-        content = b''.join(parts)
+    content = _filtering(image, optimized)
     idat = compress(content, 9 if optimized else 6)
     return b''.join((
-        b'\x89PNG\r\n\x1a\n',
-        L(len(ihdr)), b'IHDR', ihdr, L(crc32(ihdr, crc32(b'IHDR')) & 0xffffffff),
-        L(len(idat)), b'IDAT', idat, L(crc32(idat, crc32(b'IDAT')) & 0xffffffff),
-        L(0), b'IEND', L(crc32(b'IEND') & 0xffffffff)))
+        _header(image.width, image.height, image.n),
+        _chunk(b'IDAT', idat),
+        _chunk(b'IEND', b'')))
+
+def stream(f, width, height, kind, bands, optimized):
+    # Bands are images of full width whose heights add up to height.
+    # Each is filtered and compressed as it comes, the filters looking
+    # back at the last row of the band before.
+    if kind not in ('g', 'ga', 'rgb', 'rgba'):
+        raise ValueError('Invalid image kind.')
+    n = ('g', 'ga', 'rgb', 'rgba').index(kind) + 1
+    f.write(_header(width, height, n))
+    compressor = compressobj(9 if optimized else 6)
+    previous = None
+    for band in bands:
+        idat = compressor.compress(_filtering(band, optimized, previous))
+        if idat:
+            f.write(_chunk(b'IDAT', idat))
+        previous = band.data[-width*n:]
+    f.write(_chunk(b'IDAT', compressor.flush()))
+    f.write(_chunk(b'IEND', b''))
 
 
 
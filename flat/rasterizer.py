@@ -1,24 +1,145 @@
+from array import array
 from math import hypot, sqrt
+from operator import itemgetter
+from sys import getsizeof
 from .bezier import arc3, chop3, inflections3, offset2, offset3, polyline2, polyline3, segments2, segments3, subdivide2, subdivide3
 from .image import image
 from .misc import iround, similar
+import re
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+
+
+_runs = re.compile(b'(.)\\1*', re.DOTALL)
+
+
+
+
+def _blendpixels(data, i, j, n, alpha, color):
+    c0, c1, c2, c3 = color
+    if n == 1:
+        v = 255 - alpha
+        while i < j:
+            data[i] = (c0*alpha + data[i]*v + 127)//255
+            i += 1
+    elif n == 2:
+        u = (c1*alpha + 127)//255
+        while i < j:
+            v = (data[i+1]*(255 - u) + 127)//255
+            data[i] = (c0*u + data[i]*v + 127)//255
+            data[i+1] = u + v
+            i += 2
+    elif n == 3:
+        v = 255 - alpha
+        while i < j:
+            data[i] = (c0*alpha + data[i]*v + 127)//255
+            data[i+1] = (c1*alpha + data[i+1]*v + 127)//255
+            data[i+2] = (c2*alpha + data[i+2]*v + 127)//255
+            i += 3
+    else: # 4
+        u = (c3*alpha + 127)//255
+        while i < j:
+            v = (data[i+3]*(255 - u) + 127)//255
+            data[i] = (c0*u + data[i]*v + 127)//255
+            data[i+1] = (c1*u + data[i+1]*v + 127)//255
+            data[i+2] = (c2*u + data[i+2]*v + 127)//255
+            data[i+3] = u + v
+            i += 4
+
+def _blendspan(data, i, j, m, n, u, v, color, tables):
+    # Blend m leading components of a span through lookup tables of
+    # (c*u + d*v + 127)//255, the same rounding as used per pixel.
+    for k in range(m):
+        c = color[k]
+        key = c << 16 | u << 8 | v
+        table = tables.get(key)
+        if table is None:
+            table = tables[key] = bytes([(c*u + d*v + 127)//255 for d in range(256)])
+        data[i+k:j:n] = data[i+k:j:n].translate(table)
+
+def _blend(data, i, j, n, alpha, color, tables):
+    if j - i < 16*n:
+        _blendpixels(data, i, j, n, alpha, color)
+    elif n == 1 or n == 3:
+        _blendspan(data, i, j, n, n, alpha, 255 - alpha, color, tables)
+    else:
+        u = (color[n-1]*alpha + 127)//255
+        a = data[i+n-1:j:n]
+        for run in _runs.finditer(a):
+            start, end = run.span()
+            k, l = i + start*n, i + end*n
+            if end - start < 16:
+                _blendpixels(data, k, l, n, alpha, color)
+            else:
+                v = (a[start]*(255 - u) + 127)//255
+                data[k+n-1:l:n] = bytes((u + v,))*(end - start)
+                _blendspan(data, k, l, n-1, n, u, v, color, tables)
+
+def _blendrow(view, i, coverage, n, color):
+    mask = coverage != 0
+    alpha = (numpy.minimum(numpy.abs(coverage[mask]), 65536)*255 + 32768) >> 16
+    pixels = view[i:i + len(coverage)*n].reshape(-1, n)
+    d = pixels[mask].astype(numpy.int32)
+    c = numpy.array(color[:n], numpy.int32)
+    if n == 1 or n == 3:
+        alpha = alpha[:, None]
+        pixels[mask] = (c*alpha + d*(255 - alpha) + 127)//255
+    else:
+        u = (c[-1]*alpha + 127)//255
+        v = (d[:, -1]*(255 - u) + 127)//255
+        d[:, :-1] = (c[:-1]*u[:, None] + d[:, :-1]*v[:, None] + 127)//255
+        d[:, -1] = u + v
+        pixels[mask] = d
+
+def _sample(destination, x, y, width, height, source):
+    # Nearest neighbour, straight from the source into the visible part
+    # of the destination.
+    w, h, n = destination.width, destination.height, destination.n
+    left, right = max(0, x), min(w, x + width)
+    if left >= right:
+        return
+    sw, sh = source.width, source.height
+    indices = [((2*i + 1)*sw//(2*width))*n + c
+        for i in range(left - x, right - x) for c in range(n)]
+    pick = itemgetter(*indices)
+    data, row, previous = destination.data, None, -1
+    for j in range(max(0, y), min(h, y + height)):
+        k = (2*(j - y) + 1)*sh//(2*height)
+        if k != previous:
+            offset = k*sw*n
+            values = pick(source.data[offset:offset + sw*n])
+            row = bytes(values) if len(indices) > 1 else bytes((values,))
+            previous = k
+        i = (left + j*w)*n
+        data[i:i + len(row)] = row
 
 
 
 
 class rasterizer(object):
     
-    def __init__(self, width, height, kind):
+    def __init__(self, width, height, kind, x=0, y=0):
         if kind not in ('g', 'ga', 'rgb', 'rgba'):
             raise ValueError('Invalid image kind.')
         self.image = image(width, height, kind).white()
-        self.scanlines = [[] for i in range(height)]
+        self.ox, self.oy = x*256, y*256
+        self.cells = [None]*height
+        self.marks = [None]*height
+        self.masks = []
+        self.tables = {}
         self.top, self.bottom = height, 0
         self.mx, self.my = self.x, self.y = 0.0, 0.0
         self.mnx, self.mny = self.nx, self.ny = 0, 0
         self.first = True
     
     def edge(self, x0, y0, x1, y1):
+        ox, oy = self.ox, self.oy
+        x0, y0, x1, y1 = x0 - ox, y0 - oy, x1 - ox, y1 - oy
         if y0 < y1:
             direction = 1
         elif y0 > y1:
@@ -35,6 +156,8 @@ class rasterizer(object):
         else:
             bottom = y0
             thgir = x0
+        w = self.image.width
+        rows, flags = self.cells, self.marks
         y1 = min(y1, self.image.height*256)
         self.top = min(self.top, bottom)
         self.bottom = max(self.bottom, y1)
@@ -43,21 +166,45 @@ class rasterizer(object):
             bottom = min((top & ~255) + 256, y1)
             tfel = thgir
             thgir = x0 + ((bottom - y0)*dx + dy//2)//dy
-            scanline = self.scanlines[top//256]
+            y = top//256
+            cells, marks = rows[y], flags[y]
+            if cells is None:
+                cells = rows[y] = array('i', bytes(4*(w + 1)))
+                marks = flags[y] = bytearray(w + 1)
             if tfel//256 == thgir//256:
                 r = (tfel & ~255) + 256
                 width = (r - tfel) + (r - thgir)
                 height = bottom - top
-                area = width*height//2
-                spill = 256*height - area
-                scanline.append((tfel//256, area*direction))
-                scanline.append((tfel//256 + 1, spill*direction))
+                x = tfel//256
+                if 0 <= x < w:
+                    area = width*height//2
+                    spill = 256*height - area
+                    cells[x] += area*direction
+                    cells[x+1] += spill*direction
+                    marks[x] = marks[x+1] = 1
+                else:
+                    x = 0 if x < 0 else w
+                    cells[x] += 256*height*direction
+                    marks[x] = 1
             else:
                 left, right = min(tfel, thgir), max(tfel, thgir)
+                if right <= 0 or left >= 256*w:
+                    x = 0 if right <= 0 else w
+                    cells[x] += 256*(bottom - top)*direction
+                    marks[x] = 1
+                    continue
                 b = top
                 r = left
                 previous = 0
-                while r < right:
+                if left < 0:
+                    # Whatever lies left of the image only accumulates
+                    # into its first column.
+                    b = top + (-left*dy + ax//2)//ax
+                    cells[0] += 256*(b - top)*direction
+                    marks[0] = 1
+                    r = 0
+                end = min(right, 256*w)
+                while r < end:
                     l = r
                     r = (l & ~255) + 256
                     if r <= right:
@@ -76,9 +223,15 @@ class rasterizer(object):
                         height = bottom - b
                         spill = width*height//2
                         area = 256*height - spill
-                    scanline.append((l//256, (area + previous)*direction))
+                    x = l//256
+                    cells[x] += (area + previous)*direction
+                    marks[x] = 1
                     previous = spill
-                scanline.append(((right + 255)//256, previous*direction))
+                if right > end:
+                    previous += 256*(bottom - b)
+                x = (min(right, end) + 255)//256
+                cells[x] += previous*direction
+                marks[x] = 1
     
     def bezier2(self, x0, y0, x1, y1, x2, y2):
         steps = segments2(x0, y0, x1, y1, x2, y2, 0.25*256.0)
@@ -401,47 +554,126 @@ class rasterizer(object):
         self.edge(x-nx, y-ny, x-px, y-py)
     
     def rasterize(self, c0=0, c1=0, c2=0, c3=0):
-        w, n, data = self.image.width, self.image.n, self.image.data
+        w, n = self.image.width, self.image.n
+        data, tables = self.image.data, self.tables
+        color = c0, c1, c2, c3
+        view = numpy.frombuffer(data, numpy.uint8) if numpy else None
         top, bottom = self.top//256, (self.bottom + 255)//256
         for y in range(top, bottom):
-            scanline = self.scanlines[y]
-            scanline.sort()
+            cells, marks = self.cells[y], self.marks[y]
+            if cells is None:
+                continue
+            self.cells[y] = self.marks[y] = None
             offset = y*w
+            if view is not None and marks.count(1) >= 64:
+                left, right = marks.find(1), marks.rfind(1)
+                areas = numpy.frombuffer(cells, numpy.intc)[left:right]
+                _blendrow(view, (offset + left)*n, -numpy.cumsum(areas), n, color)
+                continue
             coverage = 0
-            for x, area in scanline:
-                if coverage == 0:
-                    x = max(0, x)
-                    i = (offset + x)*n
-                else:
-                    x = min(x, w)
-                    j = (offset + x)*n
+            x = marks.find(1)
+            while x >= 0:
+                if coverage != 0:
                     alpha = (min(abs(coverage), 65536)*255 + 32768)//65536
-                    while i < j:
-                        if n == 1:
-                            v = 255 - alpha
-                            data[i] = (c0*alpha + data[i]*v + 127)//255
-                        elif n == 2:
-                            u = (c1*alpha + 127)//255
-                            v = (data[i+1]*(255 - u) + 127)//255
-                            data[i] = (c0*u + data[i]*v + 127)//255
-                            data[i+1] = u + v
-                        elif n == 3:
-                            v = 255 - alpha
-                            data[i] = (c0*alpha + data[i]*v + 127)//255
-                            data[i+1] = (c1*alpha + data[i+1]*v + 127)//255
-                            data[i+2] = (c2*alpha + data[i+2]*v + 127)//255
-                        else: # 4
-                            u = (c3*alpha + 127)//255
-                            v = (data[i+3]*(255 - u) + 127)//255
-                            data[i] = (c0*u + data[i]*v + 127)//255
-                            data[i+1] = (c1*u + data[i+1]*v + 127)//255
-                            data[i+2] = (c2*u + data[i+2]*v + 127)//255
-                            data[i+3] = u + v
-                        i += n
-                coverage -= area
-            scanline.clear()
-        self.top, self.bottom = self.image.height, 0
+                    _blend(data, (offset + i)*n, (offset + x)*n, n, alpha, color, tables)
+                i = x
+                coverage -= cells[x]
+                x = marks.find(1, x + 1)
+        h = self.image.height
+        for x, y, width, height, alphas in self.masks:
+            left, right = max(0, -x), min(width, w - x)
+            for j in range(max(0, -y), min(height, h - y)):
+                offset = (y + j)*w + x
+                row = alphas[j*width+left:j*width+right]
+                for run in _runs.finditer(row):
+                    start, end = run.span()
+                    if row[start]:
+                        _blend(data, (offset + left + start)*n, (offset + left + end)*n,
+                            n, row[start], color, tables)
+        self.masks = []
+        self.top, self.bottom = h, 0
         return self.image
+    
+    def visible(self, bounds):
+        if bounds is None:
+            return True
+        x, y = self.ox//256, self.oy//256
+        return bounds[0] < x + self.image.width and bounds[2] > x and \
+            bounds[1] < y + self.image.height and bounds[3] > y
+    
+    def mask(self, x, y, width, height, alphas):
+        self.masks.append((x - self.ox//256, y - self.oy//256, width, height, alphas))
+    
+    def blit(self, x, y, source):
+        self.image.blit(x - self.ox//256, y - self.oy//256, source)
+    
+    def sample(self, x, y, width, height, source):
+        if self.image.kind != source.kind:
+            raise ValueError('Different image kind.')
+        _sample(self.image, x - self.ox//256, y - self.oy//256, width, height, source)
+    
+    def composite(self, x, y, layer):
+        image, source = self.image, layer.data
+        w, h, n = image.width, image.height, image.n
+        data = image.data
+        x, y = x + layer.x - self.ox//256, y + layer.y - self.oy//256
+        wn = layer.width*n
+        for j in range(max(0, -y), min(layer.height, h - y)):
+            spans, offsets, weights = layer.rows[j]
+            offset = (y + j)*w + x
+            for k in range(0, len(spans), 2):
+                start, end = max(spans[k], -x), min(spans[k+1], w - x)
+                if start < end:
+                    data[(offset + start)*n:(offset + end)*n] = \
+                        source[j*wn+start*n:j*wn+end*n]
+            for k, i in enumerate(offsets):
+                if 0 <= x + i < w:
+                    p, q = (offset + i)*n, j*wn + i*n
+                    for c in range(n):
+                        data[p+c] = source[q+c] + (data[p+c]*weights[k*n+c] + 127)//255
+
+
+
+
+class layer(object):
+    
+    __slots__ = 'x', 'y', 'width', 'height', 'data', 'rows', 'size'
+    
+    def __init__(self, x, y, white, black):
+        # The same content drawn over opaque white and black: where the
+        # two agree, it covers fully, where they differ by 255, not at
+        # all, otherwise by 255 minus the difference. Per row, covered
+        # spans are kept as start and end pairs, partially covered pixels
+        # as offsets and their differences, the colors being those over
+        # black.
+        self.x, self.y = x, y
+        self.width, self.height = w, h = black.width, black.height
+        self.data = black.data
+        self.size = getsizeof(self.data)
+        n = black.n
+        a, b = white.data, black.data
+        self.rows = []
+        for j in range(h):
+            spans, offsets, weights = array('i'), array('i'), bytearray()
+            start = None
+            for i in range(w + 1):
+                p = (j*w + i)*n
+                if i < w and a[p:p+n] == b[p:p+n]:
+                    if start is None:
+                        start = i
+                    continue
+                if start is not None:
+                    spans.append(start)
+                    spans.append(i)
+                    start = None
+                if i < w:
+                    differences = bytes(a[p+c] - b[p+c] for c in range(n))
+                    if min(differences) < 255:
+                        offsets.append(i)
+                        weights += differences
+            row = spans, offsets, bytes(weights)
+            self.rows.append(row)
+            self.size += sum(map(getsizeof, row))
 
 
 
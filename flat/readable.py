@@ -22,7 +22,8 @@ class readable(object):
         self.position += length
     
     def peek(self, prefix):
-        return self.data.startswith(prefix, self.position)
+        p = self.position
+        return self.data[p:p + len(prefix)] == prefix
     
     def read(self, length):
         p = self.position
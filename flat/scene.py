@@ -1,3 +1,4 @@
+from array import array
 from math import cos, pi, sin, sqrt
 from multiprocessing import Pool
 from random import choice, random
@@ -361,22 +362,18 @@ class scene(object):
             result = pool.imap(_pathtracing_row, range(height))
         else:
             result = map(_pathtracing_row, range(height), context*height)
-        rows = []
+        r = raw(width, height)
         step = 0
         for y, row in enumerate(result):
-            rows.append(row)
+            i = (height - 1 - y)*width*3
+            r.data[i:i+width*3] = array('d', row)
             if info:
                 s = (y + 1)*100//height
                 if s > step:
                     step = s
                     print('%d%%' % step)
-        rows.reverse()
         if info:
             print('...done in %.2f seconds.' % (time() - start))
-        r = raw(width, height)
-        for y in range(height):
-            i = y*width*3
-            r.data[i:i+width*3] = rows[y]
         return r
 
 
@@ -1,6 +1,6 @@
 from math import sqrt
 from .color import gray, spot, overprint
-from .command import moveto, lineto, curveto, closepath
+from .command import moveto, lineto, curveto, closepath, bounds
 from .misc import dump, scale
 from .path import elevated
 
@@ -462,6 +462,19 @@ class placedshape(object):
     def svg(self):
         return self.item.svg(self.k, self.x, self.y)
     
+    def bounds(self, k, x, y):
+        style = self.item.style
+        b = bounds(self.item.commands())
+        if b is None:
+            return None
+        d = 1.0
+        if style.stroke:
+            d += style.width/2.0*k*max(style.limit, sqrt(2.0))
+        factor, x, y = self.k*k, self.x*k+x, self.y*k+y
+        return (
+            b[0]*factor + x - d, b[1]*factor + y - d,
+            b[2]*factor + x + d, b[3]*factor + y + d)
+    
     def rasterize(self, rasterizer, k, x, y):
         style, commands = self.item.style, self.item.commands()
         factor = k
@@ -5,11 +5,11 @@ import struct
 
 
 def isascii(data):
-    return data.startswith(b'solid ')
+    return data[:6] == b'solid '
 
 def parseascii(data):
     triplets = []
-    pattern = re.compile(3*r'vertex\s+(\S+)\s+(\S+)\s+(\S+)\s+')
+    pattern = re.compile(3*rb'vertex\s+(\S+)\s+(\S+)\s+(\S+)\s+')
     m = pattern.search(data)
     while m:
         ax, ay, az, bx, by, bz, cx, cy, cz = map(float, m.groups())
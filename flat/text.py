@@ -1,12 +1,57 @@
+from collections import OrderedDict
+from math import ceil, floor
 from xml.sax.saxutils import escape
 from .color import gray, spot, overprint
+from .command import bounds
 from .misc import dump, inf, rmq, scale
 from .path import elevated
+from .rasterizer import rasterizer
 import re
 
 
 
 
+_subpixels = 4
+_capacity = 16*1024*1024
+_masks = OrderedDict()
+_size = 0
+_inversion = bytes(range(255, -1, -1))
+
+
+def _mask(font, index, factor, u, v):
+    # Masks are kept up to a total size in bytes, those too large not at
+    # all.
+    global _size
+    key = font, index, factor, u, v
+    mask = _masks.get(key)
+    if mask is not None:
+        _masks.move_to_end(key)
+        return mask
+    commands = font.glyph(index)
+    b = bounds(commands)
+    if b is None:
+        mask = 0, 0, 0, 0, b''
+    else:
+        dx, dy = u/_subpixels, v/_subpixels
+        left, top = int(floor(b[0]*factor + dx)), int(floor(b[1]*factor + dy))
+        right, bottom = int(ceil(b[2]*factor + dx)), int(ceil(b[3]*factor + dy))
+        r = rasterizer(right - left + 1, bottom - top + 1, 'g')
+        for c in commands:
+            c.rasterize(r, factor, dx - left, dy - top)
+        alphas = bytes(r.rasterize(0).data.translate(_inversion))
+        mask = left, top, r.image.width, r.image.height, alphas
+    if len(mask[4]) > _capacity//8:
+        return mask
+    _masks[key] = mask
+    _size += len(mask[4])
+    while _size > _capacity:
+        _, evicted = _masks.popitem(False)
+        _size -= len(evicted[4])
+    return mask
+
+
+
+
 linebreaks = re.compile(r'\r\n|[\n\v\f\r\x85\u2028\u2029]')
 boundaries = re.compile(r'([^\s-]+-?|-|^)(\s*)')
 
@@ -401,6 +446,33 @@ class placedtext(object):
             fragments.append(b''.join(line))
         return b'\n'.join(fragments)
     
+    def bounds(self, k, x, y):
+        origin, y = self.x*k+x, self.y*k+y
+        result = None
+        for height, run in self.layout.runs():
+            x = origin
+            y += height*k
+            for style, string in run:
+                previous = 0
+                factor = style.size/style.font.density*k
+                xmin, ymin, xmax, ymax = style.font.bounds
+                for character in string:
+                    code = ord(character)
+                    index = style.font.charmap.get(code, 0)
+                    x += style.font.kerning[previous].get(index, 0)*factor
+                    b = (
+                        x + xmin*factor - 1.0, y - ymax*factor - 1.0,
+                        x + xmax*factor + 1.0, y - ymin*factor + 1.0)
+                    if result is None:
+                        result = b
+                    else:
+                        result = (
+                            min(result[0], b[0]), min(result[1], b[1]),
+                            max(result[2], b[2]), max(result[3], b[3]))
+                    x += style.font.advances[index]*factor
+                    previous = index
+        return result
+    
     def rasterize(self, rasterizer, k, x, y):
         origin, y = self.x*k+x, self.y*k+y
         for height, run in self.layout.runs():
@@ -413,9 +485,13 @@ class placedtext(object):
                     code = ord(character)
                     index = style.font.charmap.get(code, 0)
                     x += style.font.kerning[previous].get(index, 0)*factor
-                    for c in style.font.glyph(index):
-                        c.rasterize(rasterizer, factor, x, y)
-                    style.color.rasterize(rasterizer)
+                    u, v = int(floor(x*_subpixels + 0.5)), int(floor(y*_subpixels + 0.5))
+                    mx, my, width, height, alphas = _mask(style.font, index, factor,
+                        u % _subpixels, v % _subpixels)
+                    if width:
+                        rasterizer.mask(u//_subpixels + mx, v//_subpixels + my,
+                            width, height, alphas)
+                        style.color.rasterize(rasterizer)
                     x += style.font.advances[index]*factor
                     previous = index
 
@@ -0,0 +1,55 @@
+from os.path import join
+from random import Random
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main
+from flat import image
+
+
+
+
+def noise(width, height, kind):
+    i = image(width, height, kind)
+    random = Random(1)
+    i.data[:] = bytes(random.randrange(256) for k in range(len(i.data)))
+    return i
+
+
+
+
+class streams(TestCase):
+    
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.jpg = join(self.directory.name, 'a.jpg')
+        self.png = join(self.directory.name, 'a.png')
+        noise(256, 256, 'rgb').jpeg(self.jpg)
+        noise(256, 256, 'rgb').ops().png(self.png)
+    
+    def tearDown(self):
+        self.directory.cleanup()
+    
+    def test_interleaved(self):
+        for path in (self.jpg, self.png):
+            a = image.open(path)
+            expected = a.copy().decompress()
+            w = a.width*a.n
+            rows = list(zip(a.ops().rows(), a.copy().ops().rows()))
+            self.assertEqual(len(rows), a.height)
+            for y, (first, second) in enumerate(rows):
+                self.assertEqual(bytes(first), bytes(second))
+                self.assertEqual(bytes(first), bytes(expected.data[y*w:(y+1)*w]))
+    
+    def test_read_while_streaming(self):
+        for path in (self.jpg, self.png):
+            a = image.open(path)
+            rows = a.ops().rows()
+            first = bytes(next(rows))
+            self.assertTrue(a.copy() == image.open(path))
+            data = first + b''.join(map(bytes, rows))
+            self.assertEqual(data, bytes(image.open(path).decompress().data))
+
+
+
+
+if __name__ == '__main__':
+    main()